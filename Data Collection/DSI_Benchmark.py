@@ -0,0 +1,164 @@
+# DSI_Benchmark
+# Repeatable ingestion benchmark for DSI_to_Python.TCPParser.
+# Each case starts DSI_Streamer_Simulator in a separate process and lets a TCPParser in this process receive from it,
+# so the CPU time measured here is the parser's alone. For every case the report contains:
+#	packets_per_s, mb_per_s			throughput of parse_data()
+#	cpu_us_per_sample				process CPU time per received sample
+#	latency_ms						percentiles of the time from recv_into() returning to the samples being in the ring buffer
+#	realtime_factor					seconds of EEG ingested per second of wall time
+#	samples_received/expected		anything missing here was lost on the way
+#	sequence_gaps, malformed_headers	from the parser's telemetry counters
+# Cases cover the DSI-7 (7 channels + trigger) and DSI-24 layouts at 300 Hz, at real time, at multiples of it and unthrottled.
+# The report is written as JSON; pass a previous report with --baseline to print the relative change per case.
+#
+# Usage:
+#	python DSI_Benchmark.py --output report.json
+#	python DSI_Benchmark.py --speeds 1 50 --baseline report.json
+
+import argparse, json, multiprocessing, os, platform, subprocess, sys, time
+import numpy as np
+
+from DSI_to_Python import TCPParser, SampleRingBuffer
+from DSI_Streamer_Simulator import DSIStreamerSimulator
+
+LAYOUTS = {'DSI-7': 8, 'DSI-24': 24}
+FSAMPLE = 300
+UNTHROTTLED_SECONDS = 600		# Seconds of EEG sent in the unthrottled (speed 0) cases.
+
+class TimedSocket:
+
+	# TimedSocket wraps the parser's socket and records when each recv_into() call returned and how many bytes it brought.
+
+	def __init__(self, sock):
+		self.sock = sock
+		self.nbytes = 0
+		self.last_recv = 0
+
+	def recv_into(self, buffer):
+		nbytes = self.sock.recv_into(buffer)
+		self.last_recv = time.perf_counter()
+		self.nbytes += nbytes
+		return nbytes
+
+	def fileno(self):
+		return self.sock.fileno()
+
+	def close(self):
+		self.sock.close()
+
+class TimedSampleRingBuffer(SampleRingBuffer):
+
+	# TimedSampleRingBuffer records the socket-to-buffer latency of every write.
+
+	def __init__(self, n_channels, capacity, sock):
+		SampleRingBuffer.__init__(self, n_channels, capacity)
+		self.sock = sock
+		self.latencies = []
+
+	def write(self, timestamps, samples):
+		SampleRingBuffer.write(self, timestamps, samples)
+		self.latencies.append(time.perf_counter() - self.sock.last_recv)
+
+def run_simulator(port_queue, n_channels, speed, duration):
+	simulator = DSIStreamerSimulator('127.0.0.1', 0, n_channels, FSAMPLE, speed=speed, duration=duration)
+	port_queue.put(simulator.port)
+	simulator.serve_forever()
+
+def run_case(layout, speed, seconds):
+
+	# run_case() streams seconds of wall time at speed times real time (or UNTHROTTLED_SECONDS of EEG at speed 0) and measures the parser.
+	n_channels = LAYOUTS[layout]
+	duration = seconds * speed if speed else UNTHROTTLED_SECONDS
+	port_queue = multiprocessing.Queue()
+	simulator = multiprocessing.Process(target=run_simulator, args=(port_queue, n_channels, speed, duration), daemon=True)
+	simulator.start()
+	try:
+		parser = TCPParser('127.0.0.1', port_queue.get(timeout=10), auto_reconnect=False)
+		parser.sock = TimedSocket(parser.sock)
+		parser.sample_buffer = TimedSampleRingBuffer(n_channels, parser.buffer_capacity, parser.sock)
+		cpu_start = time.process_time()
+		wall_start = time.perf_counter()
+		parser.parse_data()																		# Returns once the simulator closes the connection.
+		wall_time = time.perf_counter() - wall_start
+		cpu_time = time.process_time() - cpu_start
+		parser.sock.close()
+	finally:
+		simulator.terminate()
+		simulator.join()
+
+	samples = parser.sample_buffer.count
+	telemetry = parser.telemetry.stats()
+	latencies = np.array(parser.sample_buffer.latencies) * 1000
+	return {
+		'layout': layout,
+		'n_channels': n_channels,
+		'fsample': FSAMPLE,
+		'speed': speed,
+		'samples_expected': int(duration * FSAMPLE),
+		'samples_received': samples,
+		'wall_time_s': wall_time,
+		'packets_per_s': (samples + 2) / wall_time,											# The 2 extra packets are the montage and frequency events.
+		'mb_per_s': parser.sock.nbytes / wall_time / 1e6,
+		'cpu_us_per_sample': cpu_time / max(samples, 1) * 1e6,
+		'cpu_utilization': cpu_time / wall_time,
+		'realtime_factor': samples / FSAMPLE / wall_time,
+		'sequence_gaps': telemetry['sequence_gaps'],
+		'malformed_headers': telemetry['malformed_headers'],
+		'latency_ms': {name: float(np.percentile(latencies, q)) if len(latencies) else None
+					   for name, q in (('p50', 50), ('p90', 90), ('p99', 99), ('max', 100))},
+	}
+
+def git_revision():
+	try:
+		return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+									   stderr=subprocess.DEVNULL).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def compare(report, baseline):
+
+	# compare() prints the relative change of the main numbers of every case that is also in the baseline report.
+	previous = {(case['layout'], case['speed']): case for case in baseline['cases']}
+	for case in report['cases']:
+		old = previous.get((case['layout'], case['speed']))
+		if old is None:
+			continue
+		changes = []
+		for key in ('packets_per_s', 'cpu_us_per_sample'):
+			changes.append('%s %+.1f%%'%(key, (case[key] / old[key] - 1) * 100))
+		if case['latency_ms']['p99'] is not None and old['latency_ms']['p99']:
+			changes.append('p99 latency %+.1f%%'%((case['latency_ms']['p99'] / old['latency_ms']['p99'] - 1) * 100))
+		print('%s x%g: %s'%(case['layout'], case['speed'], ', '.join(changes)))
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Benchmark DSI_to_Python ingestion against the DSI-Streamer simulator.')
+	parser.add_argument('--layouts', nargs='+', default=list(LAYOUTS), choices=list(LAYOUTS))
+	parser.add_argument('--speeds', nargs='+', type=float, default=[1, 10, 50, 0], help='multiples of real time, 0 for unthrottled')
+	parser.add_argument('--seconds', type=float, default=5, help='wall time of each throttled case')
+	parser.add_argument('--output', default=None, help='file to write the JSON report to (default: stdout)')
+	parser.add_argument('--baseline', default=None, help='previous JSON report to compare against')
+	args = parser.parse_args()
+
+	cases = []
+	for layout in args.layouts:
+		for speed in args.speeds:
+			case = run_case(layout, speed, args.seconds)
+			print('%s x%g: %.0f packets/s, %.2f us CPU/sample, p99 latency %.3f ms'%(
+				layout, speed, case['packets_per_s'], case['cpu_us_per_sample'], case['latency_ms']['p99'] or 0), file=sys.stderr)
+			cases.append(case)
+	report = {
+		'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+		'revision': git_revision(),
+		'python': platform.python_version(),
+		'numpy': np.__version__,
+		'machine': platform.platform(),
+		'cases': cases,
+	}
+	if args.output:
+		with open(args.output, 'w') as report_file:
+			json.dump(report, report_file, indent=2)
+	else:
+		json.dump(report, sys.stdout, indent=2)
+	if args.baseline:
+		with open(args.baseline) as baseline_file:
+			compare(report, json.load(baseline_file))
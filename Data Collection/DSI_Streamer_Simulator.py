@@ -0,0 +1,169 @@
+# DSI_Streamer_Simulator
+# Stand-in for DSI-Streamer's TCP/IP server, for testing and benchmarking DSI_to_Python without a headset.
+# It speaks the same packet protocol TCPParser parses: every client first receives a montage event (code 9) and a
+# mains/sample frequency event (code 10), followed by a stream of EEG data packets.
+# The EEG data is either synthetic (a sine wave per channel plus noise) or replayed from a recording
+# (a csv file with a header line, a .npy array, or a directory of chunk_*.npy files as written by oz-speller's SessionWriter;
+# the first column is the timestamp and is ignored).
+# Data can be sent in real time, at N times real time, or as fast as possible (speed 0).
+#
+# Usage:
+#	python DSI_Streamer_Simulator.py --channels 24 --speed 10
+#	python DSI_Streamer_Simulator.py --replay eeg
+
+import argparse, socket, struct, threading, time, os, glob
+import numpy as np
+
+from DSI_to_Python import HEADER_START, HEADER_LENGTH, DATA_OFFSET
+
+DSI7_MONTAGE = ['Pz','F4','C4','P4','P3','C3','F3','TRG']
+DSI24_MONTAGE = ['P3','C3','F3','Fz','F4','C4','P4','Cz','Pz','Fp1','Fp2','T3','T5','O1','O2','X3','X2','F7','F8','X1','A2','T6','T4','TRG']
+TICK = 0.01		# Seconds between two sends, the simulator sends whatever samples became due in that time.
+
+def montage_for(n_channels):
+	if n_channels == len(DSI7_MONTAGE):
+		return DSI7_MONTAGE
+	if n_channels == len(DSI24_MONTAGE):
+		return DSI24_MONTAGE
+	return ['Ch%d'%(i+1) for i in range(n_channels)]
+
+def event_packet(packet_number, event_code, message, event_node=0):
+
+	# event_packet() builds a type 5 event packet: event code [12:16], sending node [16:20], message length [20:24], message [24:].
+	message = message.encode()
+	body = struct.pack('>III', event_code, event_node, len(message)) + message
+	return HEADER_START + struct.pack('>BHI', 5, len(body), packet_number) + body
+
+def data_packet_dtype(n_channels):
+
+	# data_packet_dtype() describes a type 1 EEG data packet as a packed numpy record, so a whole block of packets can be
+	# built with a few vectorized assignments.
+	return np.dtype([('start','S5'),('type','u1'),('length','>u2'),('number','>u4'),
+					 ('timestamp','>f4'),('counter','u1'),('adc_status','V6'),('data','>f4',(n_channels,))])
+
+def data_packets(first_number, timestamps, samples):
+
+	# data_packets() builds the bytes of len(timestamps) consecutive EEG data packets.
+	packets = np.zeros(len(timestamps), dtype=data_packet_dtype(samples.shape[1]))
+	packets['start'] = HEADER_START
+	packets['type'] = 1
+	packets['length'] = packets.dtype.itemsize - HEADER_LENGTH
+	packets['number'] = np.arange(first_number, first_number + len(timestamps)) & 0xFFFFFFFF
+	packets['timestamp'] = timestamps
+	packets['counter'] = packets['number'] & 0xFF
+	packets['data'] = samples
+	assert packets.dtype.fields['data'][1] == DATA_OFFSET
+	return packets.tobytes()
+
+class SyntheticSource:
+
+	# SyntheticSource generates a sine wave per channel (8 to 15 Hz, 10 uV) with added noise.
+
+	def __init__(self, n_channels, fsample, seed=0):
+		self.n_channels = n_channels
+		self.fsample = fsample
+		self.frequencies = np.linspace(8, 15, n_channels)
+		self.rng = np.random.default_rng(seed)
+
+	def read(self, first_sample, n_samples):
+		t = np.arange(first_sample, first_sample + n_samples)[:,None] / self.fsample
+		return 10 * np.sin(2 * np.pi * self.frequencies * t) + self.rng.normal(0, 2, (n_samples, self.n_channels))
+
+class ReplaySource:
+
+	# ReplaySource loops over the samples of a recording.
+
+	def __init__(self, path):
+		if os.path.isdir(path):
+			recording = np.concatenate([np.load(chunk) for chunk in sorted(glob.glob(os.path.join(path, 'chunk_*.npy')))])
+		elif path.endswith('.npy'):
+			recording = np.load(path)
+		else:
+			recording = np.loadtxt(path, delimiter=',', skiprows=1, ndmin=2)
+		self.samples = np.ascontiguousarray(recording[:,1:], dtype=np.float32)			# The first column holds the timestamps.
+		self.n_channels = self.samples.shape[1]
+
+	def read(self, first_sample, n_samples):
+		return np.take(self.samples, np.arange(first_sample, first_sample + n_samples), axis=0, mode='wrap')
+
+class DSIStreamerSimulator:
+
+	# DSIStreamerSimulator accepts TCP clients and streams the source to each of them from its own thread.
+	# speed is the multiple of real time to send at; 0 sends as fast as the client can receive.
+	# duration (in seconds of device time) limits how much data each client gets before the connection is closed.
+
+	def __init__(self, host='localhost', port=8844, n_channels=24, fsample=300, fmains=60, speed=1, duration=None, replay=None):
+		self.source = ReplaySource(replay) if replay else SyntheticSource(n_channels, fsample)
+		self.n_channels = self.source.n_channels
+		self.fsample = fsample
+		self.fmains = fmains
+		self.speed = speed
+		self.duration = duration
+		self.done = False
+		self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.server.bind((host, port))
+		self.server.listen()
+		self.port = self.server.getsockname()[1]										# The actual port, useful when port 0 was requested.
+
+	def serve_forever(self):
+		while not self.done:
+			try:
+				client, _ = self.server.accept()
+			except OSError:																# stop() closed the server socket.
+				break
+			threading.Thread(target=self.stream, args=(client,), daemon=True).start()
+
+	def start(self):
+
+		# start() serves clients from a background thread and returns immediately.
+		thread = threading.Thread(target=self.serve_forever, daemon=True)
+		thread.start()
+		return thread
+
+	def stop(self):
+		self.done = True
+		self.server.close()
+
+	def stream(self, client):
+		try:
+			client.sendall(event_packet(0, 9, ','.join(montage_for(self.n_channels)))
+						   + event_packet(1, 10, '%d,%d'%(self.fmains, self.fsample)))
+			packet_number = 2
+			sent = 0
+			total = int(self.duration * self.fsample) if self.duration is not None else None
+			start_time = time.perf_counter()
+			while not self.done and (total is None or sent < total):
+				if self.speed:
+					due = int((time.perf_counter() - start_time) * self.fsample * self.speed) - sent
+				else:
+					due = int(self.fsample * TICK * 10)										# Unthrottled: send 100 ms of data per send.
+				if total is not None:
+					due = min(due, total - sent)
+				if due > 0:
+					timestamps = np.arange(sent, sent + due) / self.fsample
+					client.sendall(data_packets(packet_number, timestamps, self.source.read(sent, due)))
+					packet_number += due
+					sent += due
+				if self.speed:
+					time.sleep(TICK)
+		except OSError:																	# The client went away.
+			pass
+		finally:
+			client.close()
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Simulate DSI-Streamer\'s TCP/IP output.')
+	parser.add_argument('--host', default='localhost')
+	parser.add_argument('--port', type=int, default=8844)
+	parser.add_argument('--channels', type=int, default=24, help='number of channels of synthetic data (8 for DSI-7, 24 for DSI-24)')
+	parser.add_argument('--fsample', type=float, default=300)
+	parser.add_argument('--fmains', type=float, default=60)
+	parser.add_argument('--speed', type=float, default=1, help='multiple of real time to send at, 0 for as fast as possible')
+	parser.add_argument('--duration', type=float, default=None, help='seconds of data to send to each client')
+	parser.add_argument('--replay', default=None, help='csv or .npy recording to replay instead of synthetic data')
+	args = parser.parse_args()
+
+	simulator = DSIStreamerSimulator(args.host, args.port, args.channels, args.fsample, args.fmains, args.speed, args.duration, args.replay)
+	print('Streaming %d channels at %gx real time on port %d'%(simulator.n_channels, args.speed, simulator.port))
+	simulator.serve_forever()
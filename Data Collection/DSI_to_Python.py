@@ -3,9 +3,9 @@
 # It contains an example parser for converting packet bytearrays to their corresponding formats described in the TCP/IP Socket Protocol Documentation (https://wearablesensing.com/downloads/TCPIP%20Support_20190924.zip).
 # The script involves opening a server socket on DSI-Streamer and connecting a client socket on Python.
 
-# As of v.1.0, the script outputs EEG data and timestamps to the command window. In addition, the script is able to plot the data in realtime.
-# Keep in mind, however, that the plot functionality is only meant as a demonstration and therefore does not adhere to any current standards.
-# The plot function plots the signals on one graph, unlabeled.
+# As of v.1.0, the script outputs EEG data and timestamps to the command window (pass verbose=True to TCPParser; otherwise it only prints
+# periodic telemetry from TCPParser.telemetry). In addition, the script is able to plot the data in realtime.
+# The plot function (EEGViewer) plots each montage channel on its own subplot, labeled with the channel name.
 # To verify correct plotting, one can introduce an artifact in the data and observe its effects on the plots.
 
 # The sample code is not certified to any specific standard. It is not intended for clinical use.
@@ -17,118 +17,1102 @@
 #
 # Copyright (c) 2014-2020 Wearable Sensing LLC
 
-import socket, struct, time
+import socket, struct, time, bisect, select
 import numpy as np
-import matplotlib.pyplot as plt
 import threading
+import asyncio
+import os, glob, queue
+from multiprocessing import shared_memory
+try:
+	from pylsl import local_clock as host_clock									# The clock the speller stamps its stimulus onsets with.
+except ImportError:
+	host_clock = time.perf_counter
+
+HEADER_START = b'@ABCD'			# Every packet starts with this sequence.
+HEADER_LENGTH = 12				# '@ABCD' + packet type (1 byte) + packet length (2 bytes) + packet number (4 bytes).
+MAX_PACKET_SIZE = HEADER_LENGTH + 0xFFFF
+RECV_BUFFER_SIZE = 921600
+SAMPLE_BUFFER_CAPACITY = 300 * 60	# One minute of samples at the 300 Hz DSI sample rate.
+DATA_OFFSET = 23				# EEG data packets: timestamp [12:16], data counter [16], ADC status [17:23], channel data [23:].
+RECORDING_MAGIC = b'DSIREC01'
+RECORDING_HEADER = '<8sII'		# Chunk file header: magic, number of channels (including the timestamp column), number of samples.
+RECORDING_CHUNK_SIZE = 300 * 10	# Samples per chunk file, ten seconds at 300 Hz.
+POLL_INTERVAL = 0.1				# Seconds parse_data() waits for data before checking done and the stall watchdog again.
+STALL_TIMEOUT = 2.0				# Seconds without any data after which the connection is considered dead.
+RECONNECT_DELAY = 0.5			# First reconnect delay in seconds, doubled after every failed attempt ...
+MAX_RECONNECT_DELAY = 30.0		# ... up to this delay.
+CLOCK_SYNC_WINDOW = 60.0		# Seconds of device time the clock mapping is fitted over.
+CLOCK_SYNC_BIN = 1.0			# The fit uses the earliest arrival in each bin of this many seconds.
+DECODE_TIME_BINS = [10e-6, 20e-6, 50e-6, 100e-6, 200e-6, 500e-6, 1e-3, 2e-3, 5e-3, 10e-3, 20e-3, 50e-3]	# Upper edges (seconds) of the decode time histogram.
+
+def decode_data_packets(buffer, offsets, packet_size):
+
+	# decode_data_packets() decodes a batch of equally sized EEG data packets in one pass.
+	# offsets are the start positions of the packets inside buffer. Packets that follow each other back to back are read
+	# through a single strided '>f4' view of the buffer, so the only copy is the big-endian to float32 conversion.
+	# Returns a (n_packets,) timestamp vector and a (n_packets, n_channels) float32 array.
+	n_channels = (packet_size - DATA_OFFSET) // 4
+	raw = np.frombuffer(buffer, dtype=np.uint8)
+	runs = []
+	run_start = 0
+	for index in range(1, len(offsets) + 1):
+		if index == len(offsets) or offsets[index] - offsets[index - 1] != packet_size:	# A run ends where an event packet (or a gap) sits between data packets.
+			first = offsets[run_start]
+			n_packets = index - run_start
+			timestamps = np.ndarray((n_packets,), dtype='>f4', buffer=raw, offset=first + 12, strides=(packet_size,))
+			samples = np.ndarray((n_packets, n_channels), dtype='>f4', buffer=raw, offset=first + DATA_OFFSET, strides=(packet_size, 4))
+			runs.append((timestamps, samples))
+			run_start = index
+	if len(runs) == 1:
+		return runs[0][0].astype(np.float32), runs[0][1].astype(np.float32)
+	return (np.concatenate([timestamps for timestamps, _ in runs]).astype(np.float32),
+			np.concatenate([samples for _, samples in runs]).astype(np.float32))
+
+def decode_event_packet(packet):
+
+	# decode_event_packet() returns the (event_code, event_node, message) of a type 5 event packet.
+	(event_code, event_node) = struct.unpack('>II',packet[12:20])
+	message = ''
+	if len(packet)>24:
+		message_length = struct.unpack('>I',packet[20:24])[0]
+		message = bytes(packet[24:24+message_length]).decode()
+	return event_code, event_node, message
+
+def event_times(packet_headers, timestamps, previous_timestamp):
+
+	# event_times() returns the device time of each packet in packet_headers: the timestamp of the last data packet received
+	# before it, or previous_timestamp (the last timestamp of the previous read) if no data packet came before it in this read.
+	times = []
+	data_index = 0
+	for packet_header in packet_headers:
+		if packet_header[0] == 1:
+			data_index += 1
+		times.append(float(timestamps[data_index - 1]) if data_index else previous_timestamp)
+	return times
+
+def event_sample_indices(packet_headers, first_index):
+
+	# event_sample_indices() returns, for each packet in packet_headers, the absolute index (as counted by SampleRingBuffer.count)
+	# of the first data sample received after it. first_index is the count of the ring buffer before this read was written.
+	indices = []
+	data_index = first_index
+	for packet_header in packet_headers:
+		indices.append(data_index)
+		if packet_header[0] == 1:
+			data_index += 1
+	return indices
+
+class PacketBuffer:
+
+	# PacketBuffer reassembles DSI-Streamer packets from a TCP byte stream.
+	# Received bytes are written in place into a preallocated bytearray (see free_space()) and complete packets are cut out
+	# using the length field of the '>BHI' header. A packet cut across two reads stays in the buffer until the rest of it arrives.
+
+	def __init__(self, size=RECV_BUFFER_SIZE):
+		self.size = size
+		self.buffer = bytearray(size)
+		self.view = memoryview(self.buffer)
+		self.start = 0																	# Offset of the first byte that has not been parsed yet.
+		self.end = 0																	# Offset one past the last received byte.
+		self.malformed = 0																# Number of times bytes had to be skipped to find the next header.
+
+	def free_space(self):
+
+		# free_space() returns the writable tail of the buffer, to be filled by recv_into() (or an asyncio BufferedProtocol).
+		return self.view[self.end:]
+
+	def received(self, nbytes):
+		self.end += nbytes
+
+	def split_packets(self):
+
+		# split_packets() cuts every complete packet out of the buffer.
+		# Packets are returned as memoryview slices of the buffer, so they are only valid until the next compact() call.
+		packets = []
+		packet_headers = []
+		packet_offsets = []
+		while True:
+			start = self.buffer.find(HEADER_START, self.start, self.end)
+			if start == -1:																# No header start left; keep the tail in case it holds the beginning of '@ABCD'.
+				self.start = max(self.start, self.end - len(HEADER_START) + 1)
+				break
+			if start != self.start:														# There were stray bytes in front of this header.
+				self.malformed += 1
+			if self.end - start < HEADER_LENGTH:										# The header itself is still incomplete.
+				self.start = start
+				break
+			packet_header = struct.unpack_from('>BHI', self.buffer, start + 5)
+			end = start + HEADER_LENGTH + packet_header[1]								# The packet length field counts the bytes following the 12 byte header.
+			if end > self.end:															# The packet body is still incomplete.
+				self.start = start
+				break
+			packets.append(self.view[start:end])
+			packet_headers.append(packet_header)
+			packet_offsets.append(start)
+			self.start = end
+		return packets, packet_headers, packet_offsets
+
+	def decode_data(self, packet_headers, packet_offsets):
+
+		# decode_data() decodes all EEG data packets returned by one split_packets() call (see decode_data_packets()).
+		# Returns None when there were no data packets.
+		data_offsets = [offset for offset, packet_header in zip(packet_offsets, packet_headers) if packet_header[0] == 1]
+		if not data_offsets:
+			return None
+		packet_size = HEADER_LENGTH + next(packet_header[1] for packet_header in packet_headers if packet_header[0] == 1)
+		return decode_data_packets(self.buffer, data_offsets, packet_size)
+
+	def compact(self):
+
+		# compact() moves the unparsed tail (at most one partial packet) to the front of the buffer
+		# once there is no longer room for a full-size packet behind it.
+		if self.size - self.end >= MAX_PACKET_SIZE and self.start != self.end:
+			return
+		remaining = self.end - self.start
+		if remaining:
+			self.buffer[:remaining] = bytes(self.view[self.start:self.end])
+		self.start = 0
+		self.end = remaining
+
+	def reset(self):
+
+		# reset() drops everything that was received but not parsed, e.g. a partial packet from a connection that died.
+		self.start = 0
+		self.end = 0
+
+class ParserTelemetry:
+
+	# ParserTelemetry keeps cheap running counters for a parser: packets, bytes, malformed headers, sequence gaps and a histogram
+	# of the time spent decoding each read. Only the receive thread updates the counters (plain integer stores, no lock), and
+	# stats() returns a snapshot of them for any other thread. start_reporter() prints a one line summary every interval seconds.
+	# Every sequence gap is also kept in gaps as (host time, device time, expected packet number, received packet number).
+
+	def __init__(self):
+		self.start_time = time.perf_counter()
+		self.reads = 0
+		self.bytes = 0
+		self.packets = 0
+		self.data_packets = 0
+		self.event_packets = 0
+		self.malformed_headers = 0
+		self.sequence_gaps = 0
+		self.missing_packets = 0
+		self.gaps = []
+		self.stalls = 0
+		self.reconnects = 0
+		self.last_packet_number = None
+		self.decode_time_counts = [0] * (len(DECODE_TIME_BINS) + 1)					# The last bin counts everything slower than the last edge.
+		self.reporter = None
+
+	def record_read(self, nbytes, packet_headers, decode_time, malformed, packet_times=None):
+
+		# record_read() is called by the receive loop once per recv() with the packet headers it produced
+		# and their device times (see event_times()).
+		self.reads += 1
+		self.bytes += nbytes
+		self.packets += len(packet_headers)
+		self.malformed_headers = malformed
+		self.decode_time_counts[bisect.bisect_left(DECODE_TIME_BINS, decode_time)] += 1
+		if not packet_headers:
+			return
+		first_number = packet_headers[0][2]
+		last_number = packet_headers[-1][2]
+		for packet_header in packet_headers:
+			if packet_header[0] == 1:
+				self.data_packets += 1
+			elif packet_header[0] == 5:
+				self.event_packets += 1
+		# Fast path: the packet numbers of this read continue the last read without holes.
+		if (self.last_packet_number is None or first_number == self.last_packet_number + 1) and last_number - first_number == len(packet_headers) - 1:
+			self.last_packet_number = last_number
+			return
+		for index, packet_header in enumerate(packet_headers):
+			if self.last_packet_number is not None and packet_header[2] != self.last_packet_number + 1:
+				self.sequence_gaps += 1
+				self.missing_packets += max(packet_header[2] - self.last_packet_number - 1, 0)
+				self.gaps.append((time.time(), packet_times[index] if packet_times else None, self.last_packet_number + 1, packet_header[2]))
+			self.last_packet_number = packet_header[2]
+
+	def record_reconnect(self):
+
+		# record_reconnect() restarts the sequence check, as packet numbers start over on a new connection.
+		self.reconnects += 1
+		self.last_packet_number = None
+
+	def stats(self):
+		return {
+			'uptime': time.perf_counter() - self.start_time,
+			'reads': self.reads,
+			'bytes': self.bytes,
+			'packets': self.packets,
+			'data_packets': self.data_packets,
+			'event_packets': self.event_packets,
+			'malformed_headers': self.malformed_headers,
+			'sequence_gaps': self.sequence_gaps,
+			'missing_packets': self.missing_packets,
+			'gaps': list(self.gaps),
+			'stalls': self.stalls,
+			'reconnects': self.reconnects,
+			'decode_time_histogram': list(zip(DECODE_TIME_BINS + [float('inf')], self.decode_time_counts)),
+		}
+
+	def start_reporter(self, interval=5.0):
+
+		# start_reporter() prints the packet and byte rates since the previous report at most once every interval seconds.
+		def report():
+			previous = self.stats()
+			while self.reporter is not None:
+				time.sleep(interval)
+				current = self.stats()
+				elapsed = current['uptime'] - previous['uptime']
+				print('%.0f packets/s, %.3f MB/s, %d gaps (%d packets missing), %d malformed headers, %d stalls, %d reconnects'%(
+					(current['packets'] - previous['packets']) / elapsed, (current['bytes'] - previous['bytes']) / elapsed / 1e6,
+					current['sequence_gaps'], current['missing_packets'], current['malformed_headers'], current['stalls'], current['reconnects']))
+				previous = current
+		self.reporter = threading.Thread(target=report, daemon=True)
+		self.reporter.start()
+
+	def stop_reporter(self):
+		self.reporter = None
+
+class ClockSync:
+
+	# ClockSync maps the float32 device timestamps of the data packets onto the host clock (pylsl.local_clock if available,
+	# otherwise time.perf_counter), so sample blocks can be aligned with stimulus onsets recorded on the host.
+	# update() is given one (device time, host receive time) pair per read. Receive times are the true times plus a variable
+	# network and buffering delay, so the mapping host = device + offset + drift * device is fitted through the lower envelope:
+	# the earliest arrival in every completed CLOCK_SYNC_BIN seconds of the last CLOCK_SYNC_WINDOW seconds (the bin still
+	# filling may hold only a late arrival, so it waits until the next bin opens). jitter is the largest
+	# distance of those envelope points from the fitted line, i.e. the uncertainty of a mapped host time.
+	# refine() also rebuilds full float64 precision from float32 timestamps, which get coarse after long uptimes
+	# (about 8 ms per step after a day), by counting samples at the nominal sample rate.
+
+	def __init__(self, window=CLOCK_SYNC_WINDOW, bin_size=CLOCK_SYNC_BIN, max_pairs=8192):
+		self.window = window
+		self.bin_size = bin_size
+		self.device_times = np.zeros(max_pairs)
+		self.offsets = np.zeros(max_pairs)
+		self.reset()
+
+	def reset(self):
+
+		# reset() forgets the mapping, e.g. after a reconnect, when the device clock may have started over.
+		self.n_pairs = 0
+		self.cursor = 0
+		self.offset = None																# None until the first update().
+		self.drift = 0.0
+		self.jitter = 0.0
+		self.last_fit = -np.inf
+		self.last_device_time = None
+
+	def refine(self, timestamps, fsample):
+
+		# refine() returns the timestamps of a block as float64. When they agree with the previous block continued at fsample
+		# to within float32 resolution, the continued (exact) times are used instead of the rounded float32 ones.
+		timestamps = timestamps.astype(np.float64)
+		if fsample and self.last_device_time is not None:
+			expected = self.last_device_time + np.arange(1, len(timestamps) + 1) / fsample
+			tolerance = 2 * np.spacing(np.abs(timestamps).astype(np.float32)).astype(np.float64) + 1e-6
+			if np.all(np.abs(timestamps - expected) <= tolerance):
+				timestamps = expected
+		if len(timestamps):
+			self.last_device_time = timestamps[-1]
+		return timestamps
+
+	def update(self, device_time, host_time):
+		self.device_times[self.cursor] = device_time
+		self.offsets[self.cursor] = host_time - device_time
+		self.cursor = (self.cursor + 1) % len(self.device_times)
+		self.n_pairs = min(self.n_pairs + 1, len(self.device_times))
+		if self.offset is None:
+			self.offset = host_time - device_time
+		if device_time - self.last_fit >= self.bin_size:									# Refit at most once per bin.
+			self.fit()
+			self.last_fit = device_time
+
+	def fit(self):
+		device_times = self.device_times[:self.n_pairs]
+		offsets = self.offsets[:self.n_pairs]
+		recent = device_times >= device_times.max() - self.window
+		device_times, offsets = device_times[recent], offsets[recent]
+		bins = np.floor(device_times / self.bin_size)
+		complete = bins < bins.max()
+		if not complete.any():																# Until the first bin is complete, the earliest arrival so far.
+			self.drift, self.offset, self.jitter = 0.0, offsets.min(), 0.0
+			return
+		device_times, offsets, bins = device_times[complete], offsets[complete], bins[complete]
+		order = np.lexsort((offsets, bins))												# Sorted by bin, then by offset: the first of each bin is its minimum.
+		first = np.flatnonzero(np.diff(bins[order], prepend=-np.inf))
+		envelope_times = device_times[order][first]
+		envelope_offsets = offsets[order][first]
+		if len(envelope_times) >= 2:
+			self.drift, self.offset = np.polyfit(envelope_times, envelope_offsets, 1)
+		else:
+			self.drift, self.offset = 0.0, envelope_offsets[0]
+		self.jitter = float(np.max(np.abs(envelope_offsets - (self.offset + self.drift * envelope_times))))
+
+	def to_host(self, device_times):
+
+		# to_host() returns the host clock estimate of device times; the estimate is good to about +/- jitter seconds.
+		return device_times + self.offset + self.drift * device_times
+
+	def to_device(self, host_times):
+
+		# to_device() is the inverse of to_host(), e.g. to find the samples of a stimulus onset with SampleRingBuffer.window().
+		return (host_times - self.offset) / (1 + self.drift)
+
+class SampleRingBuffer:
+
+	# SampleRingBuffer keeps the most recent capacity samples in preallocated arrays and a write cursor.
+	# write() is called from the receive thread; snapshot() and window() may be called from any other thread (plotter, classifier)
+	# and always return copies taken under the lock, so a reader never sees a half-written block.
+
+	def __init__(self, n_channels, capacity=SAMPLE_BUFFER_CAPACITY):
+		self.n_channels = n_channels
+		self.capacity = capacity
+		self.timestamps = np.zeros(capacity)
+		self.samples = np.zeros((capacity, n_channels), dtype=np.float32)
+		self.cursor = 0																	# Physical index the next sample is written to.
+		self.count = 0																	# Total number of samples ever written.
+		self.lock = threading.Lock()
+
+	def write(self, timestamps, samples):
+
+		# write() copies a block of samples ((n, n_channels)) and their timestamps ((n,)) into the ring without allocating.
+		n = len(timestamps)
+		if n > self.capacity:															# Only the newest capacity samples can be kept.
+			timestamps = timestamps[-self.capacity:]
+			samples = samples[-self.capacity:]
+			n = self.capacity
+		with self.lock:
+			first = min(n, self.capacity - self.cursor)
+			self.timestamps[self.cursor:self.cursor + first] = timestamps[:first]
+			self.samples[self.cursor:self.cursor + first] = samples[:first]
+			if first < n:																# The block wraps around the end of the ring.
+				self.timestamps[:n - first] = timestamps[first:]
+				self.samples[:n - first] = samples[first:]
+			self.cursor = (self.cursor + n) % self.capacity
+			self.count += n
+
+	def __len__(self):
+		return min(self.count, self.capacity)
+
+	def _copy(self, begin, end):
+
+		# _copy() returns copies of the samples between the logical indices begin and end (0 is the oldest sample held).
+		# Must be called with the lock held.
+		oldest = (self.cursor - len(self)) % self.capacity
+		n = end - begin
+		timestamps = np.empty(n)
+		samples = np.empty((n, self.n_channels), dtype=np.float32)
+		start = (oldest + begin) % self.capacity
+		first = min(n, self.capacity - start)
+		timestamps[:first] = self.timestamps[start:start + first]
+		samples[:first] = self.samples[start:start + first]
+		timestamps[first:] = self.timestamps[:n - first]
+		samples[first:] = self.samples[:n - first]
+		return timestamps, samples
+
+	def snapshot(self, n):
+
+		# snapshot() returns the timestamps ((n,)) and samples ((n, n_channels)) of the last n samples, oldest first.
+		with self.lock:
+			held = len(self)
+			return self._copy(held - min(n, held), held)
+
+	def window(self, t0, t1):
+
+		# window() returns the samples with t0 <= timestamp <= t1. Timestamps increase with the write order, so both ends
+		# are found with a binary search on the (at most two) contiguous segments of the ring.
+		with self.lock:
+			held = len(self)
+			oldest = (self.cursor - held) % self.capacity
+			older = self.timestamps[oldest:oldest + held]								# Segment from the oldest sample up to the end of the array.
+			newer = self.timestamps[:held - len(older)]									# Wrapped segment at the start of the array.
+
+			def search(t, side):
+				if len(newer) and t > older[-1]:
+					return len(older) + int(np.searchsorted(newer, t, side))
+				return int(np.searchsorted(older, t, side))
+
+			begin = search(t0, 'left')
+			return self._copy(begin, max(search(t1, 'right'), begin))				# t0 > t1 gives an empty window.
+
+	def range(self, begin, end):
+
+		# range() returns the samples with absolute indices begin <= index < end (index 0 is the first sample ever written),
+		# e.g. an epoch starting at the sample_index of an EventStore event. Samples that have already been overwritten or
+		# not yet received are left out.
+		with self.lock:
+			oldest = self.count - len(self)
+			begin = min(max(begin, oldest), self.count)
+			end = min(max(end, begin), self.count)
+			return self._copy(begin - oldest, end - oldest)
+
+class EventStore:
+
+	# EventStore keeps every event packet (code, node, message) of a session in an append-only list sorted by device time,
+	# next to the SampleRingBuffer. Each event also records sample_index, the absolute index of the first sample received
+	# after it, so a stimulus-locked epoch is SampleRingBuffer.range(sample_index, sample_index + n) without scanning a
+	# trigger column. Lookups use bisect on the time list (and a per-code time list), so they are O(log n).
+
+	def __init__(self):
+		self.times = []
+		self.events = []																# (timestamp, sample_index, event_code, event_node, message)
+		self.code_times = {}															# event_code -> sorted times of that code
+		self.code_events = {}
+		self.lock = threading.Lock()
+
+	def append(self, timestamp, sample_index, event_code, event_node, message):
+
+		# Events arrive in time order, so append() is normally a plain list append; an out-of-order event is inserted in place.
+		event = (timestamp, sample_index, event_code, event_node, message)
+		with self.lock:
+			for times, events in ((self.times, self.events),
+					(self.code_times.setdefault(event_code, []), self.code_events.setdefault(event_code, []))):
+				if not times or timestamp >= times[-1]:
+					times.append(timestamp)
+					events.append(event)
+				else:
+					index = bisect.bisect_right(times, timestamp)
+					times.insert(index, timestamp)
+					events.insert(index, event)
+
+	def __len__(self):
+		return len(self.events)
+
+	def _index(self, event_code):
+
+		# Must be called with the lock held.
+		if event_code is None:
+			return self.times, self.events
+		return self.code_times.get(event_code, []), self.code_events.get(event_code, [])
+
+	def between(self, t0, t1, event_code=None):
+
+		# between() returns the events with t0 <= timestamp <= t1, optionally only those with event_code, oldest first.
+		with self.lock:
+			times, events = self._index(event_code)
+			return events[bisect.bisect_left(times, t0):bisect.bisect_right(times, t1)]
+
+	def nearest(self, t, event_code=None):
+
+		# nearest() returns the event closest in time to t (optionally only among event_code), or None if there is none.
+		with self.lock:
+			times, events = self._index(event_code)
+			index = bisect.bisect_left(times, t)
+			if index == len(times) or (index and t - times[index - 1] <= times[index] - t):
+				index -= 1
+			return events[index] if index >= 0 else None
+
+	def last(self, event_code=None):
+		with self.lock:
+			events = self._index(event_code)[1]
+			return events[-1] if events else None
+
+class SessionRecorder:
+
+	# SessionRecorder streams decoded samples and event packets to disk from a background writer thread.
+	# Every recorder writes to a new subdirectory of directory named after its start time (self.directory), so an earlier
+	# session is never overwritten or appended to. Samples are written to chunk files chunk_00000.bin, chunk_00001.bin, ...
+	# in it. Each chunk starts with a RECORDING_HEADER and is followed by rows of little-endian float32
+	# [timestamp, channel data...]. A chunk is written to
+	# a .part file, and at the chunk boundary its header is completed, the file is fsynced and renamed, so a crash loses
+	# at most the chunk in progress (which read_recording() still recovers up to its last complete row).
+	# Events are appended to events.tsv as timestamp, event code, node and message, and fsynced with each chunk.
+	# write_samples() and write_event() never block the receive loop: when the queue of max_blocks pending blocks is full,
+	# the block is dropped and counted in dropped_blocks.
+
+	def __init__(self, directory, chunk_size=RECORDING_CHUNK_SIZE, max_blocks=1024):
+		self.directory = os.path.join(directory, time.strftime('session_%Y%m%d_%H%M%S'))
+		self.chunk_size = chunk_size
+		self.queue = queue.Queue(maxsize=max_blocks)
+		self.dropped_blocks = 0
+		self.chunk_index = 0
+		self.chunk_file = None
+		self.chunk_samples = 0
+		os.makedirs(self.directory)														# Raises instead of writing into an existing session.
+		self.events_file = open(os.path.join(self.directory, 'events.tsv'), 'w')
+		self.thread = threading.Thread(target=self.run, daemon=True)
+		self.thread.start()
+
+	def write_samples(self, timestamps, samples):
+		try:
+			self.queue.put_nowait((1, (timestamps, samples)))
+		except queue.Full:
+			self.dropped_blocks += 1
+
+	def write_event(self, timestamp, event_code, event_node, message):
+
+		# write_event() records an event packet; timestamp is the device time of the data packet received just before it.
+		try:
+			self.queue.put_nowait((5, (timestamp, event_code, event_node, message)))
+		except queue.Full:
+			self.dropped_blocks += 1
+
+	def close(self):
+
+		# close() waits for the queued blocks to be written and finalizes the last chunk.
+		self.queue.put((None, None))
+		self.thread.join()
+
+	def run(self):
+		while True:
+			packet_type, payload = self.queue.get()
+			if packet_type is None:
+				break
+			if packet_type == 1:
+				self.append_samples(*payload)
+			else:
+				timestamp, event_code, event_node, message = payload
+				self.events_file.write('%r\t%d\t%d\t%s\n'%(timestamp, event_code, event_node, message.replace('\t', ' ').replace('\n', ' ')))
+		self.finish_chunk()
+		self.events_file.close()
+
+	def append_samples(self, timestamps, samples):
+		rows = np.empty((len(timestamps), samples.shape[1] + 1), dtype='<f4')
+		rows[:,0] = timestamps
+		rows[:,1:] = samples
+		while len(rows):
+			if self.chunk_file is None:
+				self.chunk_file = open(self.chunk_path() + '.part', 'wb')
+				self.chunk_file.write(struct.pack(RECORDING_HEADER, RECORDING_MAGIC, rows.shape[1], 0))
+			n = min(len(rows), self.chunk_size - self.chunk_samples)
+			self.chunk_file.write(rows[:n].tobytes())
+			self.chunk_samples += n
+			rows = rows[n:]
+			if self.chunk_samples == self.chunk_size:
+				self.finish_chunk()
+
+	def chunk_path(self):
+		return os.path.join(self.directory, 'chunk_%05d.bin'%self.chunk_index)
+
+	def finish_chunk(self):
+		if self.chunk_file is None:
+			return
+		self.chunk_file.seek(struct.calcsize('<8sI'))
+		self.chunk_file.write(struct.pack('<I', self.chunk_samples))
+		self.chunk_file.flush()
+		os.fsync(self.chunk_file.fileno())
+		self.chunk_file.close()
+		os.replace(self.chunk_path() + '.part', self.chunk_path())
+		self.events_file.flush()
+		os.fsync(self.events_file.fileno())
+		self.chunk_file = None
+		self.chunk_samples = 0
+		self.chunk_index += 1
+
+def read_recording(directory):
+
+	# read_recording() loads a session directory written by a SessionRecorder (its .directory). Returns (n,) timestamps, (n, n_channels) samples and a list of
+	# (timestamp, event_code, event_node, message) events. An unfinished .part chunk is read up to its last complete row.
+	timestamps = []
+	samples = []
+	for path in sorted(glob.glob(os.path.join(directory, 'chunk_*.bin')) + glob.glob(os.path.join(directory, 'chunk_*.bin.part'))):
+		with open(path, 'rb') as chunk_file:
+			magic, n_columns, n_samples = struct.unpack(RECORDING_HEADER, chunk_file.read(struct.calcsize(RECORDING_HEADER)))
+			if magic != RECORDING_MAGIC:
+				raise ValueError(path + ' is not a DSI recording chunk')
+			rows = np.frombuffer(chunk_file.read(), dtype='<f4')
+		rows = rows[:len(rows) // n_columns * n_columns].reshape(-1, n_columns)
+		timestamps.append(rows[:,0])
+		samples.append(rows[:,1:])
+	events = []
+	events_path = os.path.join(directory, 'events.tsv')
+	if os.path.exists(events_path):
+		with open(events_path) as events_file:
+			for line in events_file:
+				timestamp, event_code, event_node, message = line.rstrip('\n').split('\t', 3)
+				events.append((float(timestamp), int(event_code), int(event_node), message))
+	if not timestamps:
+		return np.zeros(0, dtype=np.float32), np.zeros((0, 0), dtype=np.float32), events
+	return np.concatenate(timestamps), np.concatenate(samples), events
+
+class SharedSampleRing:
+
+	# SharedSampleRing is a sample ring buffer in multiprocessing.shared_memory, so one TCPParser can publish a headset stream
+	# to consumer processes (classifier, viewer, recorder) that attach by name and read it without pickling or sharing a GIL.
+	# The segment starts with an int64 header [capacity, n_channels, count, pending] and a float64 fsample, followed by the
+	# float64 timestamps and the float32 samples. count is the number of samples published so far (the sequence counter);
+	# pending is raised before a block is written and count after it, so a reader can tell when the writer lapped the data
+	# it was copying and retry.
+	#
+	# Publisher:	TCPParser('localhost', 8844, shared_memory_name='dsi24')
+	# Consumer:		ring = SharedSampleRing('dsi24')
+	#				timestamps, samples, sequence, lost = ring.read_since(0)
+
+	HEADER_SIZE = 64
+
+	def __init__(self, name, n_channels=None, capacity=SAMPLE_BUFFER_CAPACITY, fsample=0):
+		self.owner = n_channels is not None												# The publisher creates the segment, consumers attach to it.
+		if self.owner:
+			size = self.HEADER_SIZE + capacity * 8 + capacity * n_channels * 4
+			self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+		else:
+			try:																		# Attaching must not make this process unlink the segment on exit.
+				self.shm = shared_memory.SharedMemory(name=name, track=False)			# Python 3.13 and later.
+			except TypeError:
+				self.shm = shared_memory.SharedMemory(name=name)
+				if os.name == 'posix':														# Only POSIX segments are registered, by their name with a leading slash.
+					from multiprocessing import resource_tracker
+					resource_tracker.unregister('/' + self.shm.name, 'shared_memory')
+		self.header = np.ndarray((4,), dtype=np.int64, buffer=self.shm.buf)
+		self.fsample_slot = np.ndarray((1,), dtype=np.float64, buffer=self.shm.buf, offset=32)
+		if self.owner:
+			self.header[:] = (capacity, n_channels, 0, 0)
+			self.fsample_slot[0] = fsample
+		self.capacity, self.n_channels = int(self.header[0]), int(self.header[1])
+		self.timestamps = np.ndarray((self.capacity,), dtype=np.float64, buffer=self.shm.buf, offset=self.HEADER_SIZE)
+		self.samples = np.ndarray((self.capacity, self.n_channels), dtype=np.float32, buffer=self.shm.buf,
+								  offset=self.HEADER_SIZE + self.capacity * 8)
+
+	@property
+	def count(self):
+		return int(self.header[2])
+
+	@property
+	def fsample(self):
+		return float(self.fsample_slot[0])
+
+	@fsample.setter
+	def fsample(self, fsample):
+		self.fsample_slot[0] = fsample
+
+	def write_samples(self, timestamps, samples):
+
+		# write_samples() publishes a block of samples. Only the owning process may write.
+		n = len(timestamps)
+		if n > self.capacity:
+			timestamps = timestamps[-self.capacity:]
+			samples = samples[-self.capacity:]
+		count = int(self.header[2])
+		self.header[3] = count + n
+		cursor = (count + n - len(timestamps)) % self.capacity
+		first = min(len(timestamps), self.capacity - cursor)
+		self.timestamps[cursor:cursor + first] = timestamps[:first]
+		self.samples[cursor:cursor + first] = samples[:first]
+		self.timestamps[:len(timestamps) - first] = timestamps[first:]
+		self.samples[:len(timestamps) - first] = samples[first:]
+		self.header[2] = count + n
+
+	def read_since(self, sequence, max_samples=None):
+
+		# read_since() returns the samples published after sequence (a count from an earlier call, or 0 to start).
+		# Returns (timestamps, samples, new_sequence, lost), where lost is the number of samples that were overwritten before
+		# this consumer got to them.
+		while True:
+			count = int(self.header[2])
+			begin = max(sequence, count - self.capacity)
+			if max_samples is not None:
+				begin = max(begin, count - max_samples)
+			n = count - begin
+			start = begin % self.capacity
+			first = min(n, self.capacity - start)
+			timestamps = np.concatenate((self.timestamps[start:start + first], self.timestamps[:n - first]))
+			samples = np.concatenate((self.samples[start:start + first], self.samples[:n - first]))
+			if int(self.header[3]) - self.capacity <= begin:									# The writer has not started overwriting what was copied.
+				return timestamps, samples, count, max(count - self.capacity - sequence, 0)
+
+	def snapshot(self, n):
+
+		# snapshot() returns the timestamps and samples of the last n published samples, oldest first.
+		timestamps, samples, _, _ = self.read_since(0, n)
+		return timestamps, samples
+
+	def close(self):
+
+		# close() detaches from the segment; the publisher also removes it.
+		self.header = self.fsample_slot = self.timestamps = self.samples = None			# Views must be released before the segment can be closed.
+		self.shm.close()
+		if self.owner:
+			self.shm.unlink()
 
 class TCPParser: # The script contains one main class which handles DSI-Streamer data packet parsing.
 
-	def __init__(self, host, port):
+	def __init__(self, host, port, buffer_capacity=SAMPLE_BUFFER_CAPACITY, verbose=False, shared_memory_name=None,
+				 auto_reconnect=True, stall_timeout=STALL_TIMEOUT):
 		self.host = host
 		self.port = port
 		self.done = False
-		self.data_log = b''
+		self.verbose = verbose															# Print every decoded packet (slow, for debugging only).
+		self.telemetry = ParserTelemetry()
+		self.packet_buffer = PacketBuffer()												# Preallocated receive buffer, filled in place by recv_into().
 		self.latest_packets = []
 		self.latest_packet_headers = []
 		self.latest_packet_data = np.zeros((1,1))
-		self.signal_log = np.zeros((1,20))
-		self.time_log = np.zeros((1,20))
+		self.latest_packet_data_timestamp = np.zeros((1,1))
+		self.buffer_capacity = buffer_capacity
+		self.sample_buffer = None														# Created once the first data packet tells us the number of channels.
+		self.recorder = None															# Optional SessionRecorder that every sample block and event is passed to.
+		self.events = EventStore()														# Every event packet, indexed by device time and sample index.
+		self.shared_memory_name = shared_memory_name
+		self.publisher = None															# SharedSampleRing for other processes, created with sample_buffer if shared_memory_name is set.
 		self.montage = []
 		self.fsample = 0
 		self.fmains = 0
+		self.clock = ClockSync()														# Maps device timestamps to host_clock().
+		self.latest_host_timestamps = np.zeros(0)										# Host time estimates of the last decoded block (see ClockSync).
+		self.auto_reconnect = auto_reconnect											# Reconnect when the connection closes or stalls instead of returning from parse_data().
+		self.stall_timeout = stall_timeout
 
 		self.sock = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
 		self.sock.connect((self.host,self.port))
-		
+
+	def reconnect(self):
+
+		# reconnect() replaces a dead connection, retrying with exponential backoff until it succeeds or done is set.
+		# Parsing resumes into the same sample_buffer; only the partial packet of the old connection is dropped.
+		self.sock.close()
+		delay = RECONNECT_DELAY
+		while not self.done:
+			try:
+				self.sock = socket.create_connection((self.host,self.port), timeout=delay)
+				self.sock.settimeout(None)
+				self.packet_buffer.reset()
+				self.clock.reset()
+				self.telemetry.record_reconnect()
+				return True
+			except OSError:
+				retry_time = time.perf_counter() + delay
+				while not self.done and time.perf_counter() < retry_time:
+					time.sleep(POLL_INTERVAL)
+				delay = min(delay * 2, MAX_RECONNECT_DELAY)
+		return False
+
+	def connection_failed(self):
+
+		# connection_failed() decides what happens after the connection closed or stalled: reconnect, or stop parsing.
+		return self.auto_reconnect and self.reconnect()
+
 	def parse_data(self):
 		
-		# parse_data() receives DSI-Streamer TCP/IP packets and updates the signal_log and time_log attributes
-		# which capture EEG data and time data, respectively, from the last 100 EEG data packets (by default) into a numpy array.
+		# parse_data() receives DSI-Streamer TCP/IP packets and writes the EEG data and timestamps into sample_buffer,
+		# a ring buffer holding the last buffer_capacity samples (one minute at 300 Hz by default).
+		# The socket is polled with select() so done is checked at least every POLL_INTERVAL seconds. If no data arrives for
+		# stall_timeout seconds, or the connection closes, the parser reconnects (see reconnect()) unless auto_reconnect is off.
+		# However parse_data() returns, done is set afterwards, so threads waiting on the parser (e.g. EEGViewer) stop too,
+		# and the shared memory segment of the publisher is removed, so the next run can create it again.
+		try:
+			self.receive()
+		finally:
+			self.done = True
+			if self.publisher is not None:
+				self.publisher.close()
+				self.publisher = None
+
+	def receive(self):
+
+		# receive() is the loop of parse_data().
+		last_receive = time.perf_counter()
 		while not self.done:
-			data = self.sock.recv(921600)
-			self.data_log += data
-			if self.data_log.find(b'@ABCD',0,len(self.data_log)) != -1:										# The script looks for the '@ABCD' header start sequence to find packets.
-				for index,packet in enumerate(self.data_log.split(b'@ABCD')[1:]):							# The script then splits the inbound transmission by the header start sequence to collect the individual packets.
-					self.latest_packets.append(b'@ABCD' + packet)
-				for packet in self.latest_packets:
-					self.latest_packet_headers.append(struct.unpack('>BHI',packet[5:12]))
-				self.data_log = b''
-
-
-				for index, packet_header in enumerate(self.latest_packet_headers):		
-					# For each packet in the transmission, the script will append the signal data and timestamps to their respective logs.
-					if packet_header[0] == 1:
-						if np.shape(self.signal_log)[0] == 1:												# The signal_log must be initialized based on the headset and number of available channels.
-							self.signal_log = np.zeros((int(len(self.latest_packets[index][23:])/4),20))
-							self.time_log = np.zeros((1,20))
-							self.latest_packet_data = np.zeros((int(len(self.latest_packets[index][23:])/4),1))
-
-						self.latest_packet_data = np.reshape(struct.unpack('>%df'%(len(self.latest_packets[index][23:])/4),self.latest_packets[index][23:]),(len(self.latest_packet_data),1))
-						self.latest_packet_data_timestamp = np.reshape(struct.unpack('>f',self.latest_packets[index][12:16]),(1,1))
-
-						print("Timestamps: " + str(self.latest_packet_data_timestamp))
-						print("Signal Data: " + str(self.latest_packet_data))
-
-						self.signal_log = np.append(self.signal_log,self.latest_packet_data,1)
-						self.time_log = np.append(self.time_log,self.latest_packet_data_timestamp,1)
-						self.signal_log = self.signal_log[:,-100:]
-						self.time_log = self.time_log[:,-100:]
-					## Non-data packet handling
-					if packet_header[0] == 5:
-						(event_code, event_node) = struct.unpack('>II',self.latest_packets[index][12:20])
-						if len(self.latest_packets[index])>24:
-							message_length = struct.unpack('>I',self.latest_packets[index][20:24])[0]
+			readable, _, _ = select.select([self.sock], [], [], POLL_INTERVAL)
+			if not readable:
+				if time.perf_counter() - last_receive > self.stall_timeout:				# Stall watchdog.
+					self.telemetry.stalls += 1
+					if not self.connection_failed():
+						break
+					last_receive = time.perf_counter()
+				continue
+			try:
+				nbytes = self.sock.recv_into(self.packet_buffer.free_space())
+			except OSError:
+				nbytes = 0
+			if nbytes == 0:																# DSI-Streamer closed the connection.
+				if not self.connection_failed():
+					break
+				last_receive = time.perf_counter()
+				continue
+			receive_time = host_clock()
+			last_receive = time.perf_counter()
+			decode_start = last_receive
+			self.packet_buffer.received(nbytes)
+			self.latest_packets, self.latest_packet_headers, packet_offsets = self.packet_buffer.split_packets()	# The script cuts complete packets out of the buffer by their length field.
+
+			# All EEG data packets of this transmission are decoded together and written to the ring buffer in one step.
+			previous_timestamp = float(self.latest_packet_data_timestamp[0,0])
+			first_index = self.sample_buffer.count if self.sample_buffer is not None else 0
+			timestamps = []
+			decoded = self.packet_buffer.decode_data(self.latest_packet_headers, packet_offsets)
+			if decoded is not None:
+				timestamps, samples = decoded
+				timestamps = self.clock.refine(timestamps, self.fsample)
+				self.clock.update(timestamps[-1], receive_time)
+				self.latest_host_timestamps = self.clock.to_host(timestamps)
+				if self.sample_buffer is None:													# The sample_buffer must be initialized based on the headset and number of available channels.
+					self.sample_buffer = SampleRingBuffer(samples.shape[1], self.buffer_capacity)
+					if self.shared_memory_name is not None:
+						self.publisher = SharedSampleRing(self.shared_memory_name, samples.shape[1], self.buffer_capacity, self.fsample)
+
+				self.latest_packet_data = samples[-1].reshape(-1,1)
+				self.latest_packet_data_timestamp = timestamps[-1:].reshape(1,1)
+
+				if self.verbose:
+					print("Timestamps: " + str(timestamps))
+					print("Signal Data: " + str(samples))
+
+				self.sample_buffer.write(timestamps, samples)
+				if self.recorder is not None:
+					self.recorder.write_samples(timestamps, samples)
+				if self.publisher is not None:
+					self.publisher.write_samples(timestamps, samples)
+
+			packet_times = event_times(self.latest_packet_headers, timestamps, previous_timestamp)
+			sample_indices = event_sample_indices(self.latest_packet_headers, first_index)
+			for index, packet_header in enumerate(self.latest_packet_headers):
+				## Non-data packet handling
+				if packet_header[0] == 5:
+					event_code, event_node, message = decode_event_packet(self.latest_packets[index])
+					self.events.append(packet_times[index], sample_indices[index], event_code, event_node, message)
+					if self.recorder is not None:
+						self.recorder.write_event(packet_times[index], event_code, event_node, message)
+					if self.verbose:
 						print("Event code = " + str(event_code) + "  Node = " + str(event_node))
-						if event_code == 9:
-							montage = self.latest_packets[index][24:24+message_length].decode()
-							montage = montage.strip()
+					if event_code == 9:
+						montage = message.strip()
+						if self.verbose:
 							print("Montage = " + montage)
-							self.montage = montage.split(',')
-						if event_code == 10:
-							frequencies = self.latest_packets[index][24:24+message_length].decode()
+						self.montage = montage.split(',')
+					if event_code == 10:
+						frequencies = message
+						if self.verbose:
 							print("Mains,Sample = "+ frequencies)
-							mains,sample = frequencies.split(',')
-							self.fsample = float(sample)
-							self.fmains = float(mains)
+						mains,sample = frequencies.split(',')
+						self.fsample = float(sample)
+						self.fmains = float(mains)
+						if self.publisher is not None:
+							self.publisher.fsample = self.fsample
+			self.telemetry.record_read(nbytes, self.latest_packet_headers, time.perf_counter() - decode_start, self.packet_buffer.malformed, packet_times)
 			self.latest_packets = []
 			self.latest_packet_headers = []
+			self.packet_buffer.compact()
 
 	def example_plot(self):
 
-		# example_plot() uses the threading Python library and matplotlib to plot the EEG data in realtime. 
-		# The plots are unlabeled but users can refer to the TCP/IP Socket Protocol Documentation to understand how to discern the different plots given their indices.
-		# Ideally, each EEG plot should have its own subplot but for demonstrative purposes, they are all plotted on the same figure.
+		# example_plot() uses the threading Python library to receive data in the background and shows it in an EEGViewer.
+		# The data thread stops once the viewer window is closed.
 		data_thread = threading.Thread(target=self.parse_data)
 		data_thread.start()
 
-		refresh_rate = 0.03
-		duration = 60	# The default plot duration is 60 seconds.
-		runtime = 0
-
-		fig = plt.figure()
-
-		while True: # runtime < duration/refresh_rate:
-			self.signal_log = self.signal_log[:,-1000:]
-			self.time_log = self.time_log[:,-1000:]
-			plt.clf()
-			try:
-				plt.plot(self.time_log.T,self.signal_log.T)
-			except: pass
-			plt.gca().legend(self.montage)
-			plt.xlabel('Timestamp')
-			plt.ylabel('Peak-to-Peak uV')
-			plt.title('DSI-Streamer TCP/IP EEG Sensor Data Output')
-			plt.pause(refresh_rate)
-			runtime += 1
-		plt.show()
+		EEGViewer(self).run()
 
 		self.done = True
 		data_thread.join()
 
+def minmax_decimate(timestamps, samples, n_bins):
+
+	# minmax_decimate() reduces (n,) timestamps and (n, n_channels) samples to at most 2 * n_bins points per channel by keeping
+	# the minimum and maximum of every bin, so peaks and artifacts survive the decimation. The oldest samples that do not
+	# fill a whole bin are dropped.
+	bin_size = len(timestamps) // n_bins
+	if bin_size < 2:
+		return timestamps, samples
+	n = bin_size * n_bins
+	bins = samples[-n:].reshape(n_bins, bin_size, -1)
+	decimated = np.empty((2 * n_bins, samples.shape[1]), dtype=samples.dtype)
+	decimated[0::2] = bins.min(axis=1)
+	decimated[1::2] = bins.max(axis=1)
+	return np.repeat(timestamps[-n::bin_size], 2), decimated
+
+class EEGViewer:
+
+	# EEGViewer plots the last window_seconds of a parser's sample_buffer with one subplot per montage channel.
+	# The figure is drawn once; afterwards every refresh only restores the saved background, updates the persistent Line2D
+	# objects with set_data() and blits them, after min/max decimation to the pixel width of the axes.
+	# The y range of a channel is only changed (with a full redraw) when its data leaves the current limits.
+
+	def __init__(self, parser, window_seconds=5, refresh_rate=0.03):
+		self.parser = parser
+		self.window_seconds = window_seconds
+		self.refresh_rate = refresh_rate
+		self.closed = False
+		self.background = None
+
+	def setup(self, n_channels):
+		import matplotlib.pyplot as plt																# Imported here so the parser can be used on machines without a display.
+		self.fig, self.axes = plt.subplots(n_channels, 1, sharex=True, squeeze=False, figsize=(10, max(4, 0.4 * n_channels)))
+		self.axes = self.axes[:,0]
+		self.lines = []
+		for index, ax in enumerate(self.axes):
+			line, = ax.plot([], [], linewidth=0.8, animated=True)								# Animated lines are left out of full redraws and blitted instead.
+			self.lines.append(line)
+			ax.set_ylabel(self.parser.montage[index] if index < len(self.parser.montage) else str(index), rotation=0, ha='right', va='center')
+			ax.set_yticks([])
+			ax.set_xlim(-self.window_seconds, 0)
+			ax.set_ylim(-100, 100)
+		self.axes[-1].set_xlabel('Time (s)')
+		self.axes[0].set_title('DSI-Streamer TCP/IP EEG Sensor Data Output (uV)')
+		self.fig.canvas.mpl_connect('draw_event', self.on_draw)
+		self.fig.canvas.mpl_connect('close_event', self.on_close)
+		plt.show(block=False)
+		plt.pause(0.1)
+
+	def on_draw(self, event):
+		# Any full redraw (first show, resize, new y limits) invalidates the saved background.
+		self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+
+	def on_close(self, event):
+		self.closed = True
+
+	def update(self):
+		timestamps, samples = self.parser.sample_buffer.snapshot(int(self.window_seconds * (self.parser.fsample or 300)))
+		if len(timestamps) == 0:
+			return
+		width = int(self.axes[0].bbox.width)														# Screen pixels available for the time axis.
+		timestamps, samples = minmax_decimate(timestamps - timestamps[-1], samples, max(width, 1))
+		rescale = False
+		for index, (ax, line) in enumerate(zip(self.axes, self.lines)):
+			line.set_data(timestamps, samples[:,index])
+			low, high = ax.get_ylim()
+			data_low, data_high = samples[:,index].min(), samples[:,index].max()
+			if data_low < low or data_high > high:
+				margin = max((data_high - data_low) * 0.1, 1)
+				ax.set_ylim(data_low - margin, data_high + margin)
+				rescale = True
+		if rescale or self.background is None:
+			self.fig.canvas.draw()																	# Triggers on_draw() and saves the new background.
+		self.fig.canvas.restore_region(self.background)
+		for ax, line in zip(self.axes, self.lines):
+			ax.draw_artist(line)
+		self.fig.canvas.blit(self.fig.bbox)
+		self.fig.canvas.flush_events()
+
+	def run(self):
+
+		# run() refreshes the plot every refresh_rate seconds until the window is closed.
+		while self.parser.sample_buffer is None and not self.parser.done:						# The number of channels is only known after the first data packet.
+			time.sleep(self.refresh_rate)
+		if self.parser.sample_buffer is None:
+			return
+		self.setup(self.parser.sample_buffer.n_channels)
+		while not self.closed:
+			update_start = time.perf_counter()
+			self.update()
+			time.sleep(max(self.refresh_rate - (time.perf_counter() - update_start), 0))
+
+class AsyncTCPParser(asyncio.BufferedProtocol):
+
+	# AsyncTCPParser is the asyncio counterpart of TCPParser. It lets several headsets and inference tasks share one event loop
+	# instead of running one blocking receive thread per connection, and can be cancelled at any time.
+	# The event loop writes received bytes straight into the PacketBuffer (get_buffer()/buffer_updated()), and decoded items
+	# are queued for an async iterator:
+	#	(1, (timestamps, samples, host_timestamps))	a decoded block of EEG samples (see decode_data_packets()) with the host
+	#											clock estimate of each sample (see ClockSync; clock.jitter is its uncertainty)
+	#	(5, (event_code, event_node, message))	an event packet; montage (code 9) and frequency (code 10) events also update
+	#											montage, fsample and fmains.
+	# Reading from the socket is paused while queue_size or more items are waiting, which pushes back on DSI-Streamer through TCP.
+	# Items already received when reading is paused still arrive; once max_queue items are waiting they are dropped and counted
+	# in dropped_blocks, so a stalled consumer cannot grow the queue without bound.
+	#
+	# Example:
+	#	parser = await AsyncTCPParser.connect('localhost', 8844)
+	#	async for packet_type, payload in parser:
+	#		...
+
+	def __init__(self, queue_size=64, buffer_capacity=SAMPLE_BUFFER_CAPACITY, max_queue=1024):
+		self.queue_size = queue_size
+		self.queue = asyncio.Queue(maxsize=max_queue)
+		self.dropped_blocks = 0
+		self.paused = False
+		self.transport = None
+		self.telemetry = ParserTelemetry()
+		self.packet_buffer = PacketBuffer()
+		self.buffer_capacity = buffer_capacity
+		self.sample_buffer = None
+		self.recorder = None
+		self.events = EventStore()
+		self.last_timestamp = 0.0
+		self.clock = ClockSync()
+		self.montage = []
+		self.fsample = 0
+		self.fmains = 0
+
+	@classmethod
+	async def connect(cls, host, port, **kwargs):
+		loop = asyncio.get_running_loop()
+		_, parser = await loop.create_connection(lambda: cls(**kwargs), host, port)
+		return parser
+
+	def connection_made(self, transport):
+		self.transport = transport
+
+	def get_buffer(self, sizehint):
+		return self.packet_buffer.free_space()
+
+	def buffer_updated(self, nbytes):
+		receive_time = host_clock()
+		decode_start = time.perf_counter()
+		self.packet_buffer.received(nbytes)
+		packets, packet_headers, packet_offsets = self.packet_buffer.split_packets()
+		previous_timestamp = self.last_timestamp
+		first_index = self.sample_buffer.count if self.sample_buffer is not None else 0
+		timestamps = []
+		decoded = self.packet_buffer.decode_data(packet_headers, packet_offsets)
+		if decoded is not None:
+			timestamps, samples = decoded
+			timestamps = self.clock.refine(timestamps, self.fsample)
+			self.clock.update(timestamps[-1], receive_time)
+			self.last_timestamp = float(timestamps[-1])
+			if self.sample_buffer is None:
+				self.sample_buffer = SampleRingBuffer(samples.shape[1], self.buffer_capacity)
+			self.sample_buffer.write(timestamps, samples)
+			if self.recorder is not None:
+				self.recorder.write_samples(timestamps, samples)
+			self.put((1, (timestamps, samples, self.clock.to_host(timestamps))))
+		packet_times = event_times(packet_headers, timestamps, previous_timestamp)
+		sample_indices = event_sample_indices(packet_headers, first_index)
+		for packet, packet_header, packet_time, sample_index in zip(packets, packet_headers, packet_times, sample_indices):
+			if packet_header[0] == 5:
+				event = decode_event_packet(packet)
+				event_code, event_node, message = event
+				self.events.append(packet_time, sample_index, *event)
+				if self.recorder is not None:
+					self.recorder.write_event(packet_time, *event)
+				if event_code == 9:
+					self.montage = message.strip().split(',')
+				if event_code == 10:
+					mains,sample = message.split(',')
+					self.fsample = float(sample)
+					self.fmains = float(mains)
+				self.put((5, event))
+		self.telemetry.record_read(nbytes, packet_headers, time.perf_counter() - decode_start, self.packet_buffer.malformed, packet_times)
+		self.packet_buffer.compact()
+		if not self.paused and self.queue.qsize() >= self.queue_size:					# The consumer is falling behind; stop reading until it catches up.
+			self.transport.pause_reading()
+			self.paused = True
+
+	def put(self, item):
+		try:
+			self.queue.put_nowait(item)
+		except asyncio.QueueFull:
+			self.dropped_blocks += 1
+
+	def connection_lost(self, exc):
+		if self.queue.full():															# The end of the stream must not be dropped.
+			self.queue.get_nowait()
+			self.dropped_blocks += 1
+		self.queue.put_nowait(None)														# Ends the async iteration.
+
+	def close(self):
+		if self.transport is not None:
+			self.transport.close()
+
+	def __aiter__(self):
+		return self
+
+	async def __anext__(self):
+		item = await self.queue.get()
+		if item is None:
+			self.queue.put_nowait(None)													# Keep ending any later iteration as well.
+			raise StopAsyncIteration
+		if self.paused and self.queue.qsize() <= self.queue_size // 2:
+			self.transport.resume_reading()
+			self.paused = False
+		return item
+
 		
 if __name__ == "__main__":
 
 	# The script will automatically run the example_plot() method if not called from another script.
 	tcp = TCPParser('localhost',8844)
+	tcp.telemetry.start_reporter()
 	tcp.example_plot()
@@ -15,7 +15,7 @@ from scipy import signal
 import yaml
 import json
 import random
-import sys, time, serial, pickle
+import sys, os, glob, time, serial, pickle, threading, queue, hashlib, atexit
 from pylsl import local_clock
 
 sys.path.append('src')  # if run from the root project directory
@@ -43,6 +43,24 @@ if make_predictions:
     # with open("reports/trained_models/32-class_speller/DSI-7/Simon/fbtdca_1s6t.pkl", 'rb') as filehandler:
     with open("reports/trained_models/32-class_speller/DSI-24/Aidan/fbtdca_1s.pkl", 'rb') as filehandler:
         model = pickle.load(filehandler)
+dynamic_stopping = False  # whether a trial ends as soon as a shorter epoch is classified with enough margin
+stopping_windows = [0.4, 0.6, 0.8, 1.0]  # in seconds, epoch lengths scored during the stimulation, shortest first
+stopping_threshold = 0.1  # margin between the best and second best class score needed to stop early
+stopping_models = {}  # epoch length in seconds: model trained on epochs of that length
+if make_predictions and dynamic_stopping:
+    for window in stopping_windows:
+        with open("reports/trained_models/32-class_speller/DSI-24/Aidan/fbtdca_%gs.pkl" % window, 'rb') as filehandler:
+            stopping_models[window] = pickle.load(filehandler)
+use_language_model = False  # whether a character n-gram prior is fused with the classifier scores of the letter keys
+language_model_path = 'reports/language_model/speller_lm.npz'  # trained with speller_lm.py from a text corpus
+lm_weight = 0.5  # weight of the log language model prior against the classifier log probabilities
+lm_temperature = 0.05  # classifier scores are divided by this before the softmax
+lm_control_prior = 0.02  # prior of each key that does not type a character (⌂, ⌫, ⤒)
+lm_uniform = 0.1  # share of a uniform prior mixed in, so that letters the corpus never had there can still be typed
+language_model = None
+if use_language_model:
+    from speller_lm import LanguageModel, last_word, complete_word
+    language_model = LanguageModel.load(language_model_path)
 shuffled_positions = False
 shuffled_initial_positions = False
 random_positions = False
@@ -56,6 +74,15 @@ use_retina = False  # whether the monitor is a retina display
 stim_duration = 1.2  # in seconds
 isi_duration = 1  # in seconds, used both pre and post stimulations
 after_stim_padding = 0.0  # in seconds, stim remains but the data is discarded
+eeg_buffer_size = 300 * 120  # in samples, how much of the most recent EEG is kept in memory for epoching
+trigger_value = 16  # trigger channel value of the stimulus onset trigger (b'\x01' through the trigger hub)
+reject_trigger_value = 2  # trigger channel value sent when a frame is skipped; the trial is not classified
+trigger_latency = 43  # in samples, from the onset trigger to the start of the epoch
+dsi24chans = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 17, 18, 21, 22]  # DSI-24 channels passed to the model
+session_dir = 'eeg'  # every session is written to its own subdirectory here as binary chunks (see SessionWriter)
+glyph_cache_dir = 'cache/glyphs'  # pre-rendered keyboard textures, reused on later starts (see load_glyph_cache)
+session_flush_interval = 10  # in seconds, how often a chunk is written; a crash loses at most this much data
+event_flush_interval = 2  # in seconds, how often the queued experiment events are written (see EventLog)
 n_per_class = 2
 keyboard_classes = [(8, 0), (8, 0.5), (8, 1), (8, 1.5),
                     (9, 0), (9, 0.5), (9, 1), (9, 1.5),
@@ -78,8 +105,6 @@ n_keyboard_classes = len(keyboard_classes)
 #         (8.6,1.05),(9.6,0.8),(10.6,0.55),(11.6,0.3),(12.6,0.05),(13.6,1.8),(14.6,1.55),(15.6,1.3),
 #         (8.8,1.4),(9.8,1.15),(10.8,0.9),(11.8,0.65),(12.8,0.4),(13.8,0.15),(14.8,1.9),(15.8,1.65)]
 classes = keyboard_classes
-data = []
-run_count = 0
 first_call = True
 
 
@@ -195,6 +220,33 @@ def create_trial_sequence(n_per_class, classes=[(7.5, 0), (8.57, 0), (10, 0), (1
     return seq
 
 
+def create_stimulus_schedule(flickering_frames, start_positions=None, random_movements=False,
+                             linear_movement_vector=None):
+    """
+    Precompute what the flicker loop shows on each frame of a trial, so the loop only indexes arrays
+    Inputs:
+        flickering_frames : (n_frames, n_keys) luminance of each key on each frame
+        start_positions : (n_keys + 1, 2) key positions at the start of the trial (the keyboard's xys)
+        random_movements : whether the keys jitter by a random step every frame
+        linear_movement_vector : (n_keys, 2) step the keys drift by every frame, or None
+    Outputs:
+        colors : (n_frames, n_keys + 1, 3) contiguous key colors; the last (corner) key stays white
+        positions : (n_frames, n_keys + 1, 2) key positions, or None if the keys do not move
+    """
+    n_frames, n_keys = flickering_frames.shape
+    colors = np.ones((n_frames, n_keys + 1, 3))
+    colors[:, :n_keys, :] = flickering_frames[:, :, None]
+    if not random_movements and linear_movement_vector is None:
+        return colors, None
+    steps = np.zeros((n_frames, n_keys + 1, 2))  # the corner key does not move
+    if random_movements:
+        steps[:, :n_keys] += (np.random.random(size=[n_frames, n_keys, 2]) * 2 - 1) * 1
+    if linear_movement_vector is not None:
+        steps[:, :n_keys] += linear_movement_vector
+    positions = np.asarray(start_positions) + np.cumsum(steps, axis=0)
+    return colors, positions
+
+
 def create_keyboard():
     keyboard = []
     keyboard.extend(
@@ -323,6 +375,913 @@ def create_key_caps(text_strip, el_mask, phases, colors=[-1, -1, -1] * 26):
     return els
 
 
+def glyph_cache_path(key):
+    digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(glyph_cache_dir, digest)
+
+
+def load_glyph_cache(key):
+    """ Load the keyboard textures rendered for key, or return None if they are not cached
+
+    The arrays are memory-mapped read-only, so nothing is read from disk until PsychoPy
+    uploads the textures.
+
+    Returns
+    -------
+    text_strips : (len(letter sets), size, size) array, one texture strip per letter set
+    el_mask : (size, size) array
+    phases : (n_text, 2) array
+    """
+    path = glyph_cache_path(key)
+    if not os.path.isdir(path):
+        return None
+    return (np.load(os.path.join(path, 'text_strips.npy'), mmap_mode='r'),
+            np.load(os.path.join(path, 'el_mask.npy'), mmap_mode='r'),
+            np.load(os.path.join(path, 'phases.npy')))
+
+
+def save_glyph_cache(key, text_strips, el_mask, phases):
+    """ Save rendered keyboard textures for load_glyph_cache()
+
+    The files are written to a temporary directory that is renamed when complete, so an
+    interrupted save is never loaded.
+    """
+    path = glyph_cache_path(key)
+    os.makedirs(glyph_cache_dir, exist_ok=True)
+    partial = path + '.part'
+    os.makedirs(partial, exist_ok=True)
+    np.save(os.path.join(partial, 'text_strips.npy'), np.asarray(text_strips, dtype=np.float32))
+    np.save(os.path.join(partial, 'el_mask.npy'), np.asarray(el_mask, dtype=np.float32))
+    np.save(os.path.join(partial, 'phases.npy'), phases)
+    with open(os.path.join(partial, 'key.json'), 'w') as key_file:
+        json.dump(key, key_file, ensure_ascii=False)
+    try:
+        os.rename(partial, path)
+    except OSError:  # another session cached the same key first
+        pass
+
+
+class EEGRingBuffer:
+    """ Preallocated ring buffer for [timepoints by channels] EEG data
+
+    Samples are stored as float32 and their LSL timestamps as float64. Every sample
+    is written twice, at cursor and at cursor + capacity, so any run of the kept
+    samples is one contiguous slice and range() returns views without copying. The
+    arrays are allocated on the first write, once the number of channels is known.
+    Trials are read through an EpochWatcher listening to the buffer.
+
+    Parameters
+    ----------
+    capacity : int
+        number of most recent samples kept
+
+    Examples
+    --------
+    >>> eeg = EEGRingBuffer()
+    >>> epochs = EpochWatcher(eeg)
+    >>> inlets, synchronizer = get_lsl_data(eeg)
+    ...
+    >>> timestamps, samples = epochs.wait()  # see EpochWatcher
+    """
+
+    def __init__(self, capacity=eeg_buffer_size, writer=None):
+        self.capacity = capacity
+        self.writer = writer  # optional SessionWriter every block is also passed to
+        self.listeners = []  # called as listener(first_index, timestamps, samples) after each write (see EpochWatcher)
+        self.timestamps = None
+        self.samples = None
+        self.cursor = 0  # position the next sample is written to, in [0, capacity)
+        self.count = 0  # total number of samples ever written
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def write(self, timestamps, samples):
+        """ Append a block of samples ((n, channels)) and their timestamps ((n,)) """
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        samples = np.asarray(samples, dtype=np.float32)
+        if len(timestamps) == 0:
+            return
+        if self.samples is None:
+            self.timestamps = np.zeros(2 * self.capacity)
+            self.samples = np.zeros((2 * self.capacity, samples.shape[1]), dtype=np.float32)
+        if self.writer is not None:
+            self.writer.write(timestamps, samples)
+        timestamps = timestamps[-self.capacity:]
+        samples = samples[-self.capacity:]
+        n = len(timestamps)
+        with self.lock:
+            first = min(n, self.capacity - self.cursor)
+            for start in (self.cursor, self.cursor + self.capacity):
+                self.timestamps[start:start + first] = timestamps[:first]
+                self.samples[start:start + first] = samples[:first]
+            for start in (0, self.capacity):  # the part of the block that wraps around
+                self.timestamps[start:start + n - first] = timestamps[first:]
+                self.samples[start:start + n - first] = samples[first:]
+            self.cursor = (self.cursor + n) % self.capacity
+            self.count += n
+        for listener in self.listeners:
+            listener(self.count - n, timestamps, samples)
+
+    def range(self, begin, end):
+        """ Return views of the samples with absolute indices begin <= index < end
+
+        Index 0 is the first sample ever written (see count). Samples that were already
+        overwritten or not received yet are left out. The views stay valid until the
+        samples they hold are overwritten.
+        """
+        with self.lock:
+            if self.samples is None:
+                return np.zeros(0), np.zeros((0, 0), dtype=np.float32)
+            begin = min(max(begin, self.count - len(self)), self.count)
+            end = min(max(end, begin), self.count)
+            base = self.cursor + self.capacity - self.count  # position of absolute index 0 in the mirrored arrays
+            return self.timestamps[base + begin:base + end], self.samples[base + begin:base + end]
+
+
+class EpochWatcher:
+    """ Stimulus-locked epoch extraction driven by the acquisition thread
+
+    Call expect() before a stimulation starts. Every block written to the buffer after
+    that is scanned once for the onset trigger (and the reject trigger) in the trigger
+    channel, and wait() returns as soon as the onset plus a full epoch (or the first
+    length samples of it) has arrived, so the trial code neither copies the buffer nor
+    spins while the data comes in.
+
+    Parameters
+    ----------
+    buffer : EEGRingBuffer
+    length : int
+        epoch length in samples
+    trigger, reject : float
+        trigger channel values of the stimulus onset and of a rejected trial
+    latency : int
+        samples from the onset trigger to the start of the epoch
+    trigger_channel : int
+        column of the trigger channel in the buffer's samples
+
+    Examples
+    --------
+    >>> epochs = EpochWatcher(eeg)
+    >>> epochs.expect()
+    ... # stimulation, sending the onset trigger
+    >>> epoch = epochs.wait()  # (timestamps, samples) views, or None
+    >>> epoch = epochs.wait(length=120)  # the first 120 samples, during the stimulation
+    """
+
+    def __init__(self, buffer, length=int(stim_duration * 300), trigger=trigger_value,
+                 reject=reject_trigger_value, latency=trigger_latency, trigger_channel=-1):
+        self.buffer = buffer
+        self.length = length
+        self.trigger = trigger
+        self.reject = reject
+        self.latency = latency
+        self.trigger_channel = trigger_channel
+        self.condition = threading.Condition()
+        self.waiting = False
+        self.onset = None  # absolute sample index of the onset trigger
+        self.clean_onset = False  # whether the trigger channel was 0 right before the onset
+        self.rejected = False
+        self.previous = 0  # last trigger channel value seen
+        self.end = 0  # absolute sample index after the last block written
+        self.generation = 0  # number of expect() calls, a wait() from before the last one returns None
+        buffer.listeners.append(self.samples_written)
+
+    def expect(self):
+        """ Start looking for the onset trigger in the samples written from now on """
+        with self.condition:
+            self.waiting = True
+            self.onset = None
+            self.clean_onset = False
+            self.rejected = False
+            self.generation += 1
+            self.condition.notify_all()
+
+    def samples_written(self, first_index, timestamps, samples):
+        with self.condition:
+            trigger = samples[:, self.trigger_channel]
+            if self.waiting:
+                if np.any(trigger == self.reject):
+                    self.rejected = True
+                if self.onset is None:
+                    hits = np.flatnonzero(trigger == self.trigger)
+                    if len(hits):
+                        self.onset = first_index + hits[0]
+                        self.clean_onset = (trigger[hits[0] - 1] if hits[0] else self.previous) == 0
+                if self.rejected or (self.onset is not None and
+                                     first_index + len(trigger) >= self.onset + self.latency + self.length):
+                    self.waiting = False
+                if self.rejected or self.onset is not None:
+                    self.condition.notify_all()  # also wakes up waits for partial epochs
+            if len(trigger):
+                self.previous = trigger[-1]
+            self.end = first_index + len(trigger)
+
+    def wait(self, timeout=5, length=None, generation=None):
+        """ Wait for the expected epoch, or for its first length samples if length is given
+
+        generation is the value of self.generation when the trial was expected (the
+        current one by default); if expect() has been called since, the epoch belongs to
+        a later attempt and None is returned.
+
+        Returns
+        -------
+        (timestamps, samples) : views of the epoch in the buffer, [timepoints] and
+            [timepoints by channels], or None if the trial was rejected, was replaced
+            by a later attempt or no onset trigger arrived within timeout seconds
+        """
+        if length is None:
+            length = self.length
+
+        def ready():
+            return not self.waiting or self.rejected or self.generation != generation or (
+                    self.onset is not None and self.end >= self.onset + self.latency + length)
+
+        with self.condition:
+            if generation is None:
+                generation = self.generation
+            self.condition.wait_for(ready, timeout)
+            if self.generation != generation:  # expect() was called for the next attempt
+                return None
+            if self.rejected or self.onset is None or self.end < self.onset + self.latency + length:
+                self.waiting = False
+                return None
+            begin = self.onset + self.latency
+        return self.buffer.range(begin, begin + length)
+
+
+class BackgroundWriter:
+    """ Base class of the writers that save queued items on a background thread
+
+    put() queues an item and returns at once. The writer thread collects the queued
+    items and passes them as a list to save() every flush_interval seconds, and a last
+    time when close() is called. close() is registered with atexit, so the last items are
+    also saved on core.quit() and other exits. Subclasses implement save() and call
+    BackgroundWriter.__init__() once they are ready to save, since it starts the thread.
+    """
+
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def put(self, item):
+        self.queue.put(item)
+
+    def close(self):
+        """ Save everything queued so far and stop the writer thread """
+        if not self.closed:
+            self.closed = True
+            self.queue.put(None)
+            self.thread.join()
+
+    def run(self):
+        items = []
+        next_flush = time.time() + self.flush_interval
+        while True:
+            try:
+                item = self.queue.get(timeout=max(next_flush - time.time(), 0))
+            except queue.Empty:
+                item = ()
+            if item is None:
+                break
+            if item:
+                items.append(item)
+            if time.time() >= next_flush:
+                self.save(items)
+                items = []
+                next_flush = time.time() + self.flush_interval
+        self.save(items)
+
+    def save(self, items):
+        raise NotImplementedError
+
+
+class SessionWriter(BackgroundWriter):
+    """ Background writer that saves the recording as binary chunks while the session runs
+
+    Blocks passed to write() are queued and collected by a writer thread, which every
+    flush_interval seconds saves them as one [timepoints by (timestamp + channels)]
+    float64 .npy file, chunk_00000.npy, chunk_00001.npy, ... in a new subdirectory of
+    directory named after the start time (self.directory). A chunk is written to a .part
+    file, fsynced and then renamed, so a crash or kill loses at most the chunk in progress,
+    and earlier sessions are never touched. close() writes the last chunk and is
+    registered with atexit.
+
+    Parameters
+    ----------
+    directory : str
+        where the session subdirectory with the chunks and columns.csv (the channel
+        names) is created
+    columns : list of str
+        the column names, starting with 'time'
+    flush_interval : float
+        seconds between chunks
+
+    Examples
+    --------
+    >>> writer = SessionWriter('eeg', ['time', 'Pz', 'TRG'])
+    >>> writer.write(timestamps, samples)
+    ...
+    >>> writer.close()
+    >>> columns, rows = load_session(writer.directory)
+    """
+
+    def __init__(self, directory=session_dir, columns=None, flush_interval=session_flush_interval):
+        self.directory = os.path.join(directory, time.strftime('session_%Y%m%d_%H%M%S'))
+        self.n_chunks = 0
+        os.makedirs(self.directory)  # raises instead of writing into an existing session
+        if columns is not None:
+            self.set_columns(columns)
+        BackgroundWriter.__init__(self, flush_interval)
+
+    def set_columns(self, columns):
+        with open(os.path.join(self.directory, 'columns.csv'), 'w') as csv_file:
+            csv_file.write(', '.join(columns) + '\n')
+
+    def write(self, timestamps, samples):
+        """ Queue a block of samples ((n, channels)) and their timestamps ((n,)) to be saved """
+        self.put((np.asarray(timestamps, dtype=np.float64), np.asarray(samples)))
+
+    def save(self, blocks):
+        if not blocks:
+            return
+        rows = np.column_stack((np.concatenate([block[0] for block in blocks]),
+                                np.concatenate([block[1] for block in blocks])))
+        path = os.path.join(self.directory, 'chunk_%05d.npy' % self.n_chunks)
+        with open(path + '.part', 'wb') as chunk_file:
+            np.save(chunk_file, rows)
+            chunk_file.flush()
+            os.fsync(chunk_file.fileno())
+        os.replace(path + '.part', path)
+        self.n_chunks += 1
+
+
+def load_session(directory=None):
+    """ Read a recording written by SessionWriter from its session directory, by default the latest in session_dir
+
+    Returns
+    -------
+    columns : list of str, or None if no column names were saved
+    rows : [timepoints by (timestamp + channels)] numpy array
+    """
+    if directory is None:
+        directory = max(glob.glob(os.path.join(session_dir, 'session_*')))
+    columns = None
+    if os.path.exists(os.path.join(directory, 'columns.csv')):
+        with open(os.path.join(directory, 'columns.csv')) as csv_file:
+            columns = [column.strip() for column in csv_file.readline().split(',')]
+    chunks = [np.load(path) for path in sorted(glob.glob(os.path.join(directory, 'chunk_*.npy')))]
+    if not chunks:
+        return columns, np.zeros((0, 0))
+    return columns, np.concatenate(chunks)
+
+
+event_codes = {'start': 0, 'onset': 1, 'trigger': 2, 'prediction': 3, 'frameskip': 4, 'screen': 5, 'stop': 6}
+screen_codes = {'keyboard': 0, 'homescreen': 1}  # values of the 'screen' events
+event_dtype = np.dtype([('time', 'f8'), ('event', 'u1'), ('a', 'f8'), ('b', 'f8')])
+
+
+class EventLog(BackgroundWriter):
+    """ Background writer for the experiment events, so the frame loop never opens a file
+
+    log() only appends a (time, event, a, b) record to a queue; a writer thread appends
+    the queued records every flush_interval seconds to path as raw event_dtype records
+    (read them back with load_events()). The recording start ('start') and the completed
+    stimulations ('onset', a=frequency, b=phase, time=first frame) are also appended to
+    meta_path in the old meta.csv format. close() writes the rest and is registered with
+    atexit. Both files are truncated when the log is created, so it is created with the
+    recording; with path None (no recording) log() does nothing.
+
+    Events (a, b):
+        start       recording started
+        onset       stimulation (frequency, phase), time is the first frame
+        trigger     trigger byte sent (byte value)
+        prediction  predicted class (keyboard class index)
+        frameskip   stimulation aborted on a skipped frame (frame index)
+        screen      screen shown (screen_codes value)
+        stop        stimulation ended early by dynamic stopping (epoch length in s, frames shown)
+
+    Examples
+    --------
+    >>> event_log = EventLog()
+    >>> event_log.log('trigger', 1)
+    >>> event_log.log('onset', flickering_freq, phase_offset, frame_start_time)
+    >>> events = load_events()
+    >>> events[events['event'] == event_codes['prediction']]['a']
+    """
+
+    def __init__(self, path='events.bin', meta_path='meta.csv', flush_interval=event_flush_interval):
+        self.path = path
+        self.meta_path = meta_path
+        if path is not None:
+            open(path, 'wb').close()
+            open(meta_path, 'w').close()
+        BackgroundWriter.__init__(self, flush_interval)
+
+    def log(self, event, a=0, b=0, time=None):
+        """ Queue an event; time defaults to local_clock() """
+        if self.path is not None:
+            self.put((local_clock() if time is None else time, event_codes[event], a, b))
+
+    def save(self, records):
+        if not records:
+            return
+        with open(self.path, 'ab') as event_file:
+            np.array(records, dtype=event_dtype).tofile(event_file)
+        meta_rows = [(t, event, a, b) for t, event, a, b in records if event in (event_codes['start'],
+                                                                                 event_codes['onset'])]
+        if meta_rows:
+            with open(self.meta_path, 'a') as csv_file:
+                for t, event, a, b in meta_rows:
+                    if event == event_codes['start']:
+                        csv_file.write('0,0,' + str(t) + '\n')
+                    else:
+                        csv_file.write(str(a) + ', ' + str(b) + ', ' + str(t) + '\n')
+
+
+def load_events(path='events.bin'):
+    """ Read the events written by EventLog as an event_dtype record array """
+    return np.fromfile(path, dtype=event_dtype)
+
+
+class LSLSynchronizer:
+    """ Pull several LSL inlets independently and align them on their timestamps
+
+    Each inlet is read with pull_chunk() into its own buffer, and its timestamps are
+    mapped onto the local clock with the offset from inlet.time_correction(), which is
+    refreshed every offset_interval seconds. The stream with the highest nominal rate
+    defines the time grid: every one of its samples becomes a row, and the other
+    streams are sampled at the row timestamps, either by holding their last value
+    ('hold') or by linear interpolation ('linear'). A row is written once every regular
+    stream has data up to its time, or after max_delay seconds if a stream is late, so a
+    slow stream cannot stall the others. Irregular streams (nominal rate 0, such as
+    markers) are never waited for: rows always hold their last value.
+
+    Parameters
+    ----------
+    inlets : list of pylsl.StreamInlet objects
+        rows hold their channels in this order, after the timestamp
+    resample : 'hold' or 'linear'
+    max_delay : float
+        seconds a row waits for a late stream before its last value is held
+
+    Examples
+    --------
+    >>> synchronizer = LSLSynchronizer(inlets)
+    >>> synchronizer.start(eeg)  # pulls in a background thread, see synchronizer.thread
+    ...
+    >>> print(synchronizer.report())
+    """
+
+    def __init__(self, inlets, resample='hold', max_delay=0.5, max_samples=1024, timeout=0.05, offset_interval=5):
+        self.inlets = inlets
+        self.resample = resample
+        self.max_delay = max_delay
+        self.max_samples = max_samples
+        self.timeout = timeout
+        self.offset_interval = offset_interval
+        infos = [inlet.info() for inlet in inlets]
+        self.names = [info.name() for info in infos]
+        self.n_channels = [info.channel_count() for info in infos]
+        rates = [info.nominal_srate() for info in infos]
+        self.regular = [rate > 0 for rate in rates]
+        self.master = int(np.argmax(rates))  # index of the stream that defines the time grid
+        self.timestamps = [np.zeros(0) for _ in inlets]
+        self.samples = [np.zeros((0, n), dtype=np.float32) for n in self.n_channels]
+        self.offsets = [0.0] * len(inlets)  # seconds added to each stream's timestamps to get local_clock() time
+        self.next_offset_update = 0
+        self.n_rows = 0
+        self.n_held = [0] * len(inlets)  # rows in which a stream's value was held because it had no newer sample
+        self.thread = None
+
+    def update_offsets(self):
+        for inlet_idx, inlet in enumerate(self.inlets):
+            try:
+                self.offsets[inlet_idx] = inlet.time_correction(timeout=1.0)
+            except Exception as exc:  # keep the previous offset if the stream does not answer in time
+                print('time_correction failed for ' + self.names[inlet_idx] + ': ' + str(exc))
+        self.next_offset_update = local_clock() + self.offset_interval
+
+    def pull(self):
+        """ Pull the available chunks of every inlet into its buffer; returns whether anything arrived """
+        if local_clock() >= self.next_offset_update:
+            self.update_offsets()
+        received = False
+        for inlet_idx, inlet in enumerate(self.inlets):
+            samples, timestamps = inlet.pull_chunk(timeout=0.0 if received else self.timeout,
+                                                   max_samples=self.max_samples)
+            if not timestamps:
+                continue
+            received = True
+            self.timestamps[inlet_idx] = np.concatenate((self.timestamps[inlet_idx],
+                                                         np.asarray(timestamps) + self.offsets[inlet_idx]))
+            self.samples[inlet_idx] = np.concatenate((self.samples[inlet_idx],
+                                                      np.asarray(samples, dtype=np.float32)))
+        return received
+
+    def align(self):
+        """ Return the rows that are ready as (timestamps ((n,)), samples ((n, channels))), or None """
+        grid = self.timestamps[self.master]
+        limit = np.inf
+        for inlet_idx, timestamps in enumerate(self.timestamps):
+            if inlet_idx != self.master and self.regular[inlet_idx]:  # irregular streams may be silent for good
+                limit = min(limit, timestamps[-1] if len(timestamps) else -np.inf)
+        limit = max(limit, local_clock() - self.max_delay)
+        n = int(np.searchsorted(grid, limit, 'right'))
+        if n == 0:
+            return None
+        row_timestamps = grid[:n]
+        columns = []
+        for inlet_idx, (timestamps, samples) in enumerate(zip(self.timestamps, self.samples)):
+            if inlet_idx == self.master:
+                columns.append(samples[:n])
+                continue
+            if len(timestamps) == 0:
+                columns.append(np.zeros((n, self.n_channels[inlet_idx]), dtype=np.float32))
+                self.n_held[inlet_idx] += n
+                continue
+            if self.resample == 'linear' and self.regular[inlet_idx] and len(timestamps) > 1:
+                column = np.empty((n, samples.shape[1]), dtype=np.float32)
+                for channel in range(samples.shape[1]):
+                    column[:, channel] = np.interp(row_timestamps, timestamps, samples[:, channel])
+            else:
+                previous = np.searchsorted(timestamps, row_timestamps, 'right') - 1
+                column = samples[np.maximum(previous, 0)]
+                column[previous < 0] = 0
+            columns.append(column)
+            self.n_held[inlet_idx] += int(np.count_nonzero(row_timestamps > timestamps[-1]))
+            keep = max(int(np.searchsorted(timestamps, row_timestamps[-1], 'right')) - 1, 0)
+            self.timestamps[inlet_idx] = timestamps[keep:]  # the last sample before the next row is kept for holding
+            self.samples[inlet_idx] = samples[keep:]
+        self.timestamps[self.master] = grid[n:]
+        self.samples[self.master] = self.samples[self.master][n:]
+        self.n_rows += n
+        if len(columns) == 1:
+            return row_timestamps, columns[0]
+        return row_timestamps, np.hstack(columns)
+
+    def run(self, save_variable):
+        global record_start_time
+        while True:
+            received = self.pull()
+            if record_start_time and received:  # the first samples arrived, as pull_sample() used to block for
+                event_log.log('start')
+                record_start_time = False
+            rows = self.align()
+            if rows is not None:
+                save_variable.write(*rows)
+
+    def start(self, save_variable):
+        """ Pull and align in a daemon thread, writing the rows to save_variable (an EEGRingBuffer) """
+        self.thread = threading.Thread(target=self.run, args=(save_variable,), daemon=True)
+        self.thread.start()
+
+    def report(self):
+        lines = ['LSL streams (time grid: ' + self.names[self.master] + ', ' + str(self.n_rows) + ' rows)']
+        for inlet_idx, name in enumerate(self.names):
+            lines.append('  ' + name + ': clock offset ' + '%.6f' % self.offsets[inlet_idx] + ' s, held in ' +
+                         str(self.n_held[inlet_idx]) + ' rows')
+        return '\n'.join(lines)
+
+
+class InferenceJob:
+    """ One trial submitted to an InferenceWorker
+
+    prediction is the model output (None if the epoch was rejected or missing) and epoch
+    the [channels by timepoints] array passed to the model. The local_clock() times
+    submitted, started, epoch_ready, finished and picked_up give the per-trial latencies
+    (see InferenceWorker.report()), which count from stimulation_end. done is set once
+    the job is finished. A stopping job is submitted before each stimulation attempt;
+    stop_window is set to the epoch length in seconds when a shorter epoch was
+    classified with enough margin to end it early, unless the frame loop has already
+    ended the stimulation (see end_stimulation()). aborted is set when the attempt was
+    aborted on a frame skip.
+    """
+
+    def __init__(self, stopping=False):
+        self.done = threading.Event()
+        self.stopping = stopping
+        self.stop_window = None
+        self.ended = False  # the stimulation ran to the end or was aborted, the full epoch decides
+        self.aborted = False
+        self.lock = threading.Lock()
+        self.generation = None  # EpochWatcher.generation when submitted
+        self.prediction = None
+        self.scores = None  # class scores of the model, with score_classes the label of each
+        self.score_classes = None
+        self.epoch = None
+        self.clean_onset = False
+        self.submitted = local_clock()
+        self.stimulation_end = self.submitted  # set by end_stimulation() for stopping jobs, submitted during it
+        self.started = self.epoch_ready = self.finished = self.picked_up = None
+
+
+class InferenceWorker:
+    """ Run the classifier on a background thread instead of the PsychoPy frame loop
+
+    submit() queues a job for the trial that was just presented and returns at once.
+    The worker waits for the trial's epoch from the EpochWatcher, runs model.predict()
+    on the selected channels and sets job.done, while the display keeps flipping (see
+    wait_for_prediction()). Finished jobs are kept in jobs for the latency report.
+
+    For dynamic stopping, submit(stopping=True) before the stimulation: the worker then
+    scores the growing epoch with the model of each window in stopping_models as soon as
+    that much data has arrived, and stops at the first window where the best class score
+    beats the second best by threshold (see stimulation_stopped()). If no window does
+    before the frame loop ends the stimulation (see end_stimulation()), the full epoch is
+    classified with model as usual, so stim_duration stays the maximum.
+
+    Parameters
+    ----------
+    model : classifier with a predict() method taking [channels by timepoints] epochs
+    epochs : EpochWatcher
+    channels : list of int
+        columns of the buffer's samples passed to the model
+    stopping_models : dict
+        epoch length in seconds: classifier with transform() returning the class scores
+        and classes_, trained on epochs of that length
+    threshold : float
+        margin between the best and second best class score needed to stop early
+    scores : bool
+        whether to keep the class scores (model.transform()) in job.scores, for the
+        language model fusion; the prediction is then the class with the best score
+    """
+
+    def __init__(self, model, epochs, channels=dsi24chans, stopping_models=None, threshold=stopping_threshold,
+                 scores=False):
+        self.model = model
+        self.epochs = epochs
+        self.channels = channels
+        self.stopping_models = sorted((stopping_models or {}).items())
+        self.threshold = threshold
+        self.scores = scores
+        self.queue = queue.Queue()
+        self.jobs = []
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, stopping=False):
+        job = InferenceJob(stopping)
+        job.generation = self.epochs.generation  # the attempt expected when the job was submitted
+        self.jobs.append(job)
+        self.queue.put(job)
+        return job
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            job.started = local_clock()
+            if job.stopping:
+                self.score_windows(job)
+            if job.stop_window is not None:
+                job.finished = local_clock()
+                job.done.set()
+                continue
+            epoch = self.epochs.wait(generation=job.generation)
+            job.epoch_ready = local_clock()
+            if epoch is not None:
+                job.clean_onset = self.epochs.clean_onset
+                job.epoch = epoch[1][:, self.channels].T
+                try:
+                    if self.scores:
+                        job.scores = self.model.transform(job.epoch)[0]
+                        job.score_classes = self.model.classes_
+                        job.prediction = np.array([job.score_classes[np.argmax(job.scores)]])
+                    else:
+                        job.prediction = self.model.predict(job.epoch)
+                except Exception as exc:  # the trial is skipped, but the frame loop must not wait forever
+                    print('prediction failed: ' + str(exc))
+            job.finished = local_clock()
+            job.done.set()
+
+    def score_windows(self, job):
+        for window, model in self.stopping_models:
+            epoch = self.epochs.wait(length=int(window * 300), generation=job.generation)
+            if epoch is None or job.ended:
+                return
+            job.epoch_ready = local_clock()
+            job.clean_onset = self.epochs.clean_onset
+            job.epoch = epoch[1][:, self.channels].T
+            try:
+                scores = model.transform(job.epoch)[0]
+            except Exception as exc:
+                print('prediction failed: ' + str(exc))
+                return
+            second, best = np.sort(scores)[-2:]
+            if best - second >= self.threshold:
+                with job.lock:
+                    if job.ended:
+                        return
+                    job.scores = scores
+                    job.score_classes = model.classes_
+                    job.prediction = np.array([model.classes_[np.argmax(scores)]])
+                    job.stop_window = window  # set last, the frame loop stops on it
+                return
+
+    def report(self):
+        """ Return the mean, median and max queue, epoch wait, compute and end-to-end latencies in ms
+
+        Attempts aborted on a frame skip are left out. The epoch wait and end-to-end latencies
+        count from the end of the stimulation, so a stopping job's wait during the flicker
+        is not included (the epoch wait of a trial that stopped early is 0).
+        """
+        n_aborted = sum(job.aborted for job in self.jobs)
+        jobs = [job for job in self.jobs if job.picked_up is not None and not job.aborted]
+        if not jobs:
+            return 'Inference: no finished trials'
+        latencies = [('queue', [job.started - job.submitted for job in jobs]),
+                     ('epoch wait', [max(job.epoch_ready - max(job.started, job.stimulation_end), 0) for job in jobs]),
+                     ('compute', [job.finished - job.epoch_ready for job in jobs]),
+                     ('end-to-end', [job.picked_up - job.stimulation_end for job in jobs])]
+        lines = ['Inference latencies over %d trials, %d aborted attempts left out (mean / median / max ms)' % (
+            len(jobs), n_aborted)]
+        for name, values in latencies:
+            values = np.array(values) * 1000
+            lines.append('  %-10s %8.1f %8.1f %8.1f' % (name, values.mean(), np.median(values), values.max()))
+        windows = [job.stop_window for job in jobs if job.stopping]
+        if windows:
+            stopped = [window for window in windows if window is not None]
+            lines.append('Dynamic stopping: %d/%d trials stopped early, mean window %s' % (
+                len(stopped), len(windows), '%.2f s' % np.mean(stopped) if stopped else 'n/a'))
+        return '\n'.join(lines)
+
+
+def wait_for_prediction(job, stims):
+    """ Keep drawing stims and flipping the window until the InferenceWorker has finished job """
+    while not job.done.is_set():
+        for stim in stims:
+            stim.draw()
+        frame_timer.flip('waiting')
+    job.picked_up = local_clock()
+    frame_timer.mark('predict')
+    return job.prediction
+
+
+def stimulation_stopped(job):
+    """ Whether the dynamic stopping job (or None) has classified the trial, so the stimulation can end """
+    return job is not None and job.stop_window is not None
+
+
+def end_stimulation(job, aborted=False):
+    """ Tell the dynamic stopping job (or None) that the stimulation is over, so it stops scoring windows
+
+    Called when the stimulation stops early, reaches stim_duration or is aborted by a frame
+    skip (aborted=True, the job is then left out of InferenceWorker.report()). Returns
+    whether the job had stopped it early; otherwise the full epoch is classified by the
+    full-length model.
+    """
+    if job is None:
+        return False
+    with job.lock:
+        if not job.ended:
+            job.ended = True
+            job.aborted = aborted
+            job.stimulation_end = local_clock()
+        return job.stop_window is not None
+
+
+def fuse_language_model(job, layout, text):
+    """ Pick the key from the classifier scores of job and the language model prior of the next character
+
+    The scores are turned into log probabilities with a softmax (scaled by lm_temperature)
+    and lm_weight times the log prior of each key's character after text is added. Keys
+    that do not type a character get lm_control_prior, and lm_uniform of the prior is
+    uniform over the keys.
+
+    Parameters
+    ----------
+    job : InferenceJob with scores
+    layout : str
+        the character of every key (letters)
+    text : str
+        what was typed so far
+
+    Returns
+    -------
+    the keyboard class number of the chosen key
+    """
+    key_scores = np.full(n_keyboard_classes, -np.inf)
+    for score, label in zip(job.scores, job.score_classes):
+        key_scores[keyboard_classes.index(classes[label])] = score
+    log_probabilities = key_scores / lm_temperature
+    log_probabilities -= np.logaddexp.reduce(log_probabilities)
+    prior = language_model.char_probabilities(text)
+    key_prior = np.array([prior.get(' ' if key == '⎵' else key, lm_control_prior)
+                          for key in layout[:n_keyboard_classes]])
+    key_prior = (1 - lm_uniform) * key_prior / key_prior.sum() + lm_uniform / n_keyboard_classes
+    return int(np.argmax(log_probabilities + lm_weight * np.log(key_prior)))
+
+
+frame_work_flags = {'text': 1, 'predict': 2, 'io': 4, 'schedule': 8}  # work that can run before a flip (FrameTimer.mark)
+
+
+class FrameTimer:
+    """ Record the time of every win.flip() with what was on screen and what ran before it
+
+    Each flip is stored in a preallocated structured array as (time, screen, phase,
+    trial, frame, work): screen is set per trial by start_trial() (e.g. 'keyboard'),
+    phase is passed to flip() (e.g. 'isi', 'stimulation'), frame counts the flips since
+    the phase or trial changed, and work holds the frame_work_flags marked with mark()
+    since the previous flip. save() writes the records and a report with the histogram
+    of flip intervals, the jitter per screen and phase, and the work that ran before
+    each dropped frame.
+
+    Examples
+    --------
+    >>> frame_timer = FrameTimer(win)
+    >>> frame_timer.start_trial('keyboard')
+    >>> frame_timer.mark('text')  # after rebuilding a TextStim
+    >>> frame_timer.flip('isi')  # instead of win.flip()
+    """
+
+    def __init__(self, win, capacity=int(refresh_rate * 60 * 60 * 2)):
+        self.win = win
+        self.records = np.zeros(capacity, dtype=[('time', 'f8'), ('screen', 'u1'), ('phase', 'u1'),
+                                                 ('trial', 'i4'), ('frame', 'i4'), ('work', 'u1')])
+        self.n = 0
+        self.screens = {}
+        self.phases = {}
+        self.screen = 0
+        self.trial = -1
+        self.phase = -1
+        self.frame = 0
+        self.work = 0
+
+    def start_trial(self, screen):
+        self.screen = self.screens.setdefault(screen, len(self.screens))
+        self.trial += 1
+
+    def mark(self, work):
+        self.work |= frame_work_flags[work]
+
+    def flip(self, phase):
+        flip_time = self.win.flip()
+        if flip_time is None:
+            flip_time = core.getTime()
+        phase = self.phases.setdefault(phase, len(self.phases))
+        if phase == self.phase and self.n and self.records[self.n - 1]['trial'] == self.trial:
+            self.frame += 1
+        else:
+            self.phase = phase
+            self.frame = 0
+        if self.n == len(self.records):
+            self.records = np.concatenate((self.records, np.zeros_like(self.records)))
+        self.records[self.n] = (flip_time, self.screen, phase, self.trial, self.frame, self.work)
+        self.n += 1
+        self.work = 0
+        return flip_time
+
+    def report(self):
+        records = self.records[:self.n]
+        if len(records) < 2:
+            return 'Frame timing: no flips recorded'
+        intervals = np.diff(records['time']) * 1000  # the interval before each flip but the first
+        records = records[1:]
+        frame_ms = 1000 / refresh_rate
+        dropped = intervals > 1.5 * frame_ms
+        screen_names = {code: name for name, code in self.screens.items()}
+        phase_names = {code: name for name, code in self.phases.items()}
+        lines = ['Frame timing: %d flips, %d dropped (interval > %.1f ms)' % (len(intervals) + 1, dropped.sum(),
+                                                                              1.5 * frame_ms),
+                 '', 'Flip interval histogram (ms: count)']
+        counts, edges = np.histogram(np.minimum(intervals, 100), bins=np.arange(0, 102, 2))
+        for count, edge in zip(counts, edges):
+            if count:
+                lines.append('  %3d-%3d%s: %d' % (edge, edge + 2, '+' if edge == 98 else ' ', count))
+        lines += ['', 'Per screen and phase (flips, mean / std / max ms, dropped)']
+        for screen in np.unique(records['screen']):
+            for phase in np.unique(records['phase']):
+                selected = (records['screen'] == screen) & (records['phase'] == phase)
+                if selected.any():
+                    values = intervals[selected]
+                    lines.append('  %-10s %-12s %6d %7.2f %6.2f %7.2f %5d' % (
+                        screen_names.get(screen, '-'), phase_names[phase], len(values), values.mean(), values.std(),
+                        values.max(), dropped[selected].sum()))
+        lines += ['', 'Work before dropped frames (dropped frames)']
+        work = records['work'][dropped]
+        for name, flag in frame_work_flags.items():
+            lines.append('  %-10s %d' % (name, np.count_nonzero(work & flag)))
+        lines.append('  %-10s %d' % ('none', np.count_nonzero(work == 0)))
+        return '\n'.join(lines)
+
+    def save(self, path='frame_timing'):
+        """ Write the records to path.npy and the report to path.txt """
+        np.save(path + '.npy', self.records[:self.n])
+        report = self.report()
+        with open(path + '.txt', 'w') as report_file:
+            report_file.write('screens: ' + str(self.screens) + '\nphases: ' + str(self.phases) + '\n\n' + report + '\n')
+        print(report)
+
+# █████████████████████████████████████████████████████████████████████████████
+
+## Event log
+event_log = None  # EventLog, created with the recording below (it resets events.bin and meta.csv)
+
 # █████████████████████████████████████████████████████████████████████████████
 
 if use_dsi_lsl:
@@ -344,7 +1303,7 @@ if use_dsi_lsl:
 
         Parameters
         ----------
-        save_variable : empty list --> [timepoints by channels]
+        save_variable : EEGRingBuffer --> [timepoints by channels]
                                         where channels = 
                                         [timestamp, types[0]*num_channels_of_type[0] ...]
             the variable to save the data onto
@@ -355,22 +1314,22 @@ if use_dsi_lsl:
         Returns
         -------
         inlets : some length list of pylsl.StreamInlet objects
-        pull_thread : the thread instance that pulls data from the LSL constantly
+        synchronizer : the LSLSynchronizer that pulls and aligns data from the LSL constantly
 
         Note
         ----
-        To properly end the pull_thread, call all inlet.close_stream() right before
+        To properly end the synchronizer's thread, call all inlet.close_stream() right before
         you call board.stop_stream() If this isn't done, the program could freeze or 
         show error messages. Do not lose the inlets list
 
         Examples
         --------
-        >>> save_variable = []
-        >>> inlets, _ = get_eeg_lsl(save_variable) # to start pulling data from lsl
+        >>> save_variable = EEGRingBuffer(writer=SessionWriter())
+        >>> inlets, synchronizer = get_lsl_data(save_variable) # to start pulling data from lsl
         ...
         >>> for inlet in inlets:\
         >>>     inlet.close_stream()
-        >>> print(save_variable)
+        >>> save_variable.writer.close()
         """
         streams = []
         inlets = []
@@ -380,32 +1339,9 @@ if use_dsi_lsl:
         if inlets == None or len(inlets) == 0:
             raise Exception("Error: no stream found.")
 
-        def save_sample(inlets, save_variable):
-            global record_start_time
-            while True:
-                row_data = [0]
-                inlet_idx = 0
-                while inlet_idx < len(inlets):  # iterate through the inlets
-                    sample, timestamp = inlets[inlet_idx].pull_sample()
-                    if record_start_time:
-                        with open("meta.csv", 'w') as csv_file:
-                            csv_file.write('0,0,' + str(local_clock()) + '\n')
-                        record_start_time = False
-                    if (sample, timestamp) != (None, None):
-                        if inlet_idx is (len(inlets) - 1):
-                            row_data[0] = timestamp
-                        row_data.extend(sample)
-                        inlet_idx += 1  # move on to next inlet
-                    else:
-                        time.sleep(0.0001)  # wait for 0.1 ms if the data is not there yet
-                        # just to save some processing power
-                save_variable.append(row_data)
-
-        pull_thread = Thread(target=save_sample, args=(inlets, save_variable))
-        pull_thread.daemon = True
-        # pull_thread = Process(target = save_sample, args=(inlets, save_variable,), daemon=True)
-        pull_thread.start()
-        return inlets, pull_thread
+        synchronizer = LSLSynchronizer(inlets)
+        synchronizer.start(save_variable)
+        return inlets, synchronizer
 
 
     # p = Popen([os.path.join(os.getcwd(), 'src', 'dsi2lsl-win', 'dsi2lsl.exe'), '--port=COM8',
@@ -413,20 +1349,22 @@ if use_dsi_lsl:
     p = Popen(
         [os.path.join(os.getcwd(), 'src', 'dsi2lsl-win', 'dsi2lsl.exe'), '--port=COM7', '--lsl-stream-name=mystream'],
         shell=True, stdin=PIPE)  # COM4 or 8 for dsi-7 or COM12 for dsi-24
-    with open("eeg.csv", 'w') as csv_file:
-        # csv_file.write('time, Pz, F4, C4, P4, P3, C3, F3, TRG\n') # For DSI-7
-        csv_file.write(
-            'time, P3, C3, F3, Fz, F4, C4, P4, Cz, Pz, Fp1, Fp2, T3, T5, O1, O2, X3, X2, F7, F8, X1, A2, T6, T4, '
-            'TRG\n')  # For DSI-24
-    with open("meta.csv", 'w') as csv_file:
-        csv_file.write('')
+    # session_writer = SessionWriter(columns=['time', 'Pz', 'F4', 'C4', 'P4', 'P3', 'C3', 'F3', 'TRG'])  # For DSI-7
+    session_writer = SessionWriter(columns=['time', 'P3', 'C3', 'F3', 'Fz', 'F4', 'C4', 'P4', 'Cz', 'Pz', 'Fp1', 'Fp2',
+                                            'T3', 'T5', 'O1', 'O2', 'X3', 'X2', 'F7', 'F8', 'X1', 'A2', 'T6', 'T4',
+                                            'TRG'])  # For DSI-24
+    event_log = EventLog()
     time.sleep(15)
     if use_dsi_trigger:
         # dsi_serial = serial.Serial('COM2',115200) # 2 for serial trigger or 13 for trigger hub
         dsi_serial = serial.Serial('COM8', 9600)  # 2 for serial trigger or 13 for trigger hub
-    eeg = []  # receive_data() saves [timepoints by channels] here
+    eeg = EEGRingBuffer(writer=session_writer)  # synchronizer saves [timepoints by channels] here
+    epochs = EpochWatcher(eeg)
+    if make_predictions:
+        inference = InferenceWorker(model, epochs, stopping_models=stopping_models,
+                                    scores=language_model is not None)
     print(resolve_streams())
-    inlets, _ = get_lsl_data(eeg)
+    inlets, synchronizer = get_lsl_data(eeg)
 
 # █████████████████████████████████████████████████████████████████████████████
 
@@ -439,27 +1377,20 @@ if use_dsi7:
 
     @SampleCallback
     def ExampleSampleCallback_Signals(headsetPtr, packetTime, userData):
-        global run_count
-        global data
         global first_call
         h = dsi.Headset(headsetPtr)
         sample_data = [packetTime]  # time stamp
         sample_data.extend([ch.ReadBuffered() for ch in h.Channels()])  # channel voltages
-        data.append(sample_data)
-        run_count += 1
+        session_writer.write(sample_data[:1], [sample_data[1:]])
         if first_call:
             if sample_data[1] > 1e15:  # if Pz saturation error happens
                 quit()
-            with open("meta.csv", 'w') as csv_file:
-                # csv_file.write(str(time.time()) + '\n')
-                csv_file.write('0,0,' + str(local_clock()) + '\n')
+            event_log.log('start')
             first_call = False
-        if run_count >= 300:  # save data every second
-            run_count = 0
-            data_np = np.array(data)
-            with open("eeg.csv", 'a') as csv_file:
-                np.savetxt(csv_file, data_np, delimiter=',')
-            data = []
+
+
+    session_writer = SessionWriter()
+    event_log = EventLog()
 
 
     def record():
@@ -482,8 +1413,7 @@ if use_dsi7:
         headset.Connect(port)
         headset.SetSampleCallback(ExampleSampleCallback_Signals, 0)
         headset.StartDataAcquisition()
-        with open("eeg.csv", 'w') as csv_file:
-            csv_file.write('time, ' + ', '.join([ch.GetName() for ch in headset.Channels()]) + '\n')
+        session_writer.set_columns(['time'] + [ch.GetName() for ch in headset.Channels()])
         while True:
             headset.Idle(2.0)
 
@@ -650,7 +1580,7 @@ if use_cyton:
 
         Parameters
         ----------
-        save_variable : empty list --> [timepoints by channels]
+        save_variable : EEGRingBuffer --> [timepoints by channels]
                                         where channels = 
                                         [timestamp, types[0]*num_channels_of_type[0] ...]
             the variable to save the data onto
@@ -661,22 +1591,22 @@ if use_cyton:
         Returns
         -------
         inlets : some length list of pylsl.StreamInlet objects
-        pull_thread : the thread instance that pulls data from the LSL constantly
+        synchronizer : the LSLSynchronizer that pulls and aligns data from the LSL constantly
 
         Note
         ----
-        To properly end the pull_thread, call all inlet.close_stream() right before
+        To properly end the synchronizer's thread, call all inlet.close_stream() right before
         you call board.stop_stream() If this isn't done, the program could freeze or 
         show error messages. Do not lose the inlets list
 
         Examples
         --------
-        >>> save_variable = []
-        >>> inlets, _ = get_eeg_lsl(save_variable) # to start pulling data from lsl
+        >>> save_variable = EEGRingBuffer(writer=SessionWriter())
+        >>> inlets, synchronizer = get_lsl_data(save_variable) # to start pulling data from lsl
         ...
         >>> for inlet in inlets:\
         >>>     inlet.close_stream()
-        >>> print(save_variable)
+        >>> save_variable.writer.close()
         """
         streams = []
         inlets = []
@@ -687,41 +1617,21 @@ if use_cyton:
         if inlets == None or len(inlets) == 0:
             raise Exception("Error: no stream found.")
 
-        def save_sample(inlets, save_variable):
-            global record_start_time
-            while True:
-                row_data = [0]
-                inlet_idx = 0
-                while inlet_idx < len(inlets):  # iterate through the inlets
-                    sample, timestamp = inlets[inlet_idx].pull_sample()
-                    if record_start_time:
-                        with open("meta.csv", 'w') as csv_file:
-                            csv_file.write('0,0,' + str(local_clock()) + '\n')
-                        record_start_time = False
-                    if (sample, timestamp) != (None, None):
-                        if inlet_idx is (len(inlets) - 1):
-                            row_data[0] = timestamp
-                        row_data.extend(sample)
-                        inlet_idx += 1  # move on to next inlet
-                    else:
-                        time.sleep(0.0001)  # wait for 0.1 ms if the data is not there yet
-                        # just to save some processing power
-                save_variable.append(row_data)
-
-        pull_thread = Thread(target=save_sample, args=(inlets, save_variable))
-        pull_thread.daemon = True
-        pull_thread.start()
-        return inlets, pull_thread
+        synchronizer = LSLSynchronizer(inlets)
+        synchronizer.start(save_variable)
+        return inlets, synchronizer
 
 
-    with open("eeg.csv", 'w') as csv_file:
-        csv_file.write('time, N1P, N2P, N3P, N4P, N5P, N6P, N7P, N8P, D11, D12, D13\n')
-    with open("meta.csv", 'w') as csv_file:
-        csv_file.write('')
-    eeg = []  # receive_data() saves [timepoints by channels] here
+    session_writer = SessionWriter(columns=['time', 'N1P', 'N2P', 'N3P', 'N4P', 'N5P', 'N6P', 'N7P', 'N8P',
+                                            'D11', 'D12', 'D13'])
+    event_log = EventLog()
+    eeg = EEGRingBuffer(writer=session_writer)  # synchronizer saves [timepoints by channels] here
     # where channels are length 12 [timestamp, 8 EEG Channels, 3 AUX channels]
     board, stop_cyton = start_cyton_lsl()
-    inlets, _ = get_lsl_data(eeg)
+    inlets, synchronizer = get_lsl_data(eeg)
+
+if event_log is None:  # nothing is recorded, the trial events are not saved
+    event_log = EventLog(path=None)
 
 # █████████████████████████████████████████████████████████████████████████████
 
@@ -751,125 +1661,138 @@ if True:
     letters2 = '19/+2(~-3)$;4⌫%=5\'&<6"*>7!#⤓8?⮐: '
     letters3 = '12341234123412341234⏳⌚⏰ ⎚⏩ ⌨✉⏪ ⌫ '
     # letters3 = '12341234123412341234⑮⌚⏰ ⎚⏩ ⌨✉⏪ ⌫ '
-    win = psychopy.visual.Window(
-        size=(800, 800),
-        units="pix",
-        fullscr=False)
     n_text = 33
     text_cap_size = 119  # 34
-    text_strip_height = n_text * text_cap_size
-    text_strip = np.full((text_strip_height, text_cap_size), np.nan)
-    text_strip2 = np.full((text_strip_height, text_cap_size), np.nan)
-    text_strip3 = np.full((text_strip_height, text_cap_size), np.nan)
-    text = psychopy.visual.TextStim(win=win, height=60, font="Courier")
-    text2 = psychopy.visual.TextStim(win=win, height=60, font="Courier")
-    text3 = psychopy.visual.TextStim(win=win, height=60, font="Courier")
-    cap_rect_norm = [-(text_cap_size / 2.0) / (win.size[0] / 2.0),  # left
-                     +(text_cap_size / 2.0) / (win.size[1] / 2.0),  # top
-                     +(text_cap_size / 2.0) / (win.size[0] / 2.0),  # right
-                     -(text_cap_size / 2.0) / (win.size[1] / 2.0)]  # bottom
-
-    # capture the rendering of each letter
-    for (i_letter, letter) in enumerate(letters):
-        text.text = letter.upper()
-        buff = psychopy.visual.BufferImageStim(
-            win=win,
-            stim=[text],
-            rect=cap_rect_norm)
-        i_rows = slice(i_letter * text_cap_size,
-                       i_letter * text_cap_size + text_cap_size)
-        text_strip[i_rows, :] = (np.flipud(np.array(buff.image)[..., 0]) / 255.0 * 2.0 - 1.0)
-
-    # capture the rendering of each letter
-    for (i_letter, letter) in enumerate(letters2):
-        text2.text = letter.upper()
-        buff = psychopy.visual.BufferImageStim(
-            win=win,
-            stim=[text2],
-            rect=cap_rect_norm)
-        i_rows = slice(i_letter * text_cap_size,
-                       i_letter * text_cap_size + text_cap_size)
-        text_strip2[i_rows, :] = (np.flipud(np.array(buff.image)[..., 0]) / 255.0 * 2.0 - 1.0)
-
-    # capture the rendering of each letter
-    for (i_letter, letter) in enumerate(letters3):
-        text3.text = letter.upper()
-        buff = psychopy.visual.BufferImageStim(
-            win=win,
-            stim=[text3],
-            rect=cap_rect_norm)
-        i_rows = slice(i_letter * text_cap_size,
-                       i_letter * text_cap_size + text_cap_size)
-        text_strip3[i_rows, :] = (np.flipud(np.array(buff.image)[..., 0]) / 255.0 * 2.0 - 1.0)
-
-    # need to pad 'text_strip' to pow2 to use as a texture
-    new_size = max([int(np.power(2, np.ceil(np.log(dim_size) / np.log(2))))
-                    for dim_size in text_strip.shape])
-    pad_amounts = []
-    for i_dim in range(2):
-        first_offset = int((new_size - text_strip.shape[i_dim]) / 2.0)
-        second_offset = new_size - text_strip.shape[i_dim] - first_offset
-        pad_amounts.append([first_offset, second_offset])
-    text_strip = np.pad(
-        array=text_strip,
-        pad_width=pad_amounts,
-        mode="constant",
-        constant_values=0.0)
-    text_strip = (text_strip - 1) * -1  # invert the texture mapping
-
-    text_strip2 = np.pad(
-        array=text_strip2,
-        pad_width=pad_amounts,
-        mode="constant",
-        constant_values=0.0)
-    text_strip2 = (text_strip2 - 1) * -1  # invert the texture mapping
-
-    text_strip3 = np.pad(
-        array=text_strip3,
-        pad_width=pad_amounts,
-        mode="constant",
-        constant_values=0.0)
-    text_strip3 = (text_strip3 - 1) * -1  # invert the texture mapping
-
-    # make a central mask to show just one letter
-    el_mask = np.ones(text_strip.shape) * -1.0
-    # start by putting the visible section in the corner
-    el_mask[:text_cap_size, :text_cap_size] = 1.0
-
-    # then roll to the middle
-    el_mask = np.roll(el_mask,
-                      (int(new_size / 2 - text_cap_size / 2),) * 2,
-                      axis=(0, 1))
-
-    # make a central mask to show just one letter
-    el_mask2 = np.ones(text_strip2.shape) * -1.0
-    # start by putting the visible section in the corner
-    el_mask2[:text_cap_size, :text_cap_size] = 1.0
-
-    # then roll to the middle
-    el_mask2 = np.roll(el_mask2,
-                       (int(new_size / 2 - text_cap_size / 2),) * 2,
-                       axis=(0, 1))
-
-    # make a central mask to show just one letter
-    el_mask3 = np.ones(text_strip3.shape) * -1.0
-    # start by putting the visible section in the corner
-    el_mask3[:text_cap_size, :text_cap_size] = 1.0
-
-    # then roll to the middle
-    el_mask3 = np.roll(el_mask3,
-                       (int(new_size / 2 - text_cap_size / 2),) * 2,
-                       axis=(0, 1))
-
-    # work out the phase offsets for the different letters
-    base_phase = ((text_cap_size * (n_text / 2.0)) - (text_cap_size / 2.0)) / new_size
-
-    phase_inc = (text_cap_size) / float(new_size)
-
-    phases = np.array([
-        (0.0, base_phase - i_letter * phase_inc)
-        for i_letter in range(n_text)])
-    win.close()
+    glyph_font = "Courier"
+    glyph_height = 60
+    glyph_window_size = (800, 800)
+    glyph_cache_key = {'font': glyph_font, 'height': glyph_height, 'cap_size': text_cap_size, 'n_text': n_text,
+                       'letters': [letters, letters2, letters3], 'window_size': glyph_window_size,
+                       'psychopy': psychopy.__version__}
+    glyph_cache = load_glyph_cache(glyph_cache_key)
+    if glyph_cache is not None:
+        text_strips, el_mask, phases = glyph_cache
+        text_strip, text_strip2, text_strip3 = text_strips
+        el_mask2 = el_mask3 = el_mask
+    else:
+        win = psychopy.visual.Window(
+            size=glyph_window_size,
+            units="pix",
+            fullscr=False)
+        text_strip_height = n_text * text_cap_size
+        text_strip = np.full((text_strip_height, text_cap_size), np.nan)
+        text_strip2 = np.full((text_strip_height, text_cap_size), np.nan)
+        text_strip3 = np.full((text_strip_height, text_cap_size), np.nan)
+        text = psychopy.visual.TextStim(win=win, height=glyph_height, font=glyph_font)
+        text2 = psychopy.visual.TextStim(win=win, height=glyph_height, font=glyph_font)
+        text3 = psychopy.visual.TextStim(win=win, height=glyph_height, font=glyph_font)
+        cap_rect_norm = [-(text_cap_size / 2.0) / (win.size[0] / 2.0),  # left
+                         +(text_cap_size / 2.0) / (win.size[1] / 2.0),  # top
+                         +(text_cap_size / 2.0) / (win.size[0] / 2.0),  # right
+                         -(text_cap_size / 2.0) / (win.size[1] / 2.0)]  # bottom
+
+        # capture the rendering of each letter
+        for (i_letter, letter) in enumerate(letters):
+            text.text = letter.upper()
+            buff = psychopy.visual.BufferImageStim(
+                win=win,
+                stim=[text],
+                rect=cap_rect_norm)
+            i_rows = slice(i_letter * text_cap_size,
+                           i_letter * text_cap_size + text_cap_size)
+            text_strip[i_rows, :] = (np.flipud(np.array(buff.image)[..., 0]) / 255.0 * 2.0 - 1.0)
+
+        # capture the rendering of each letter
+        for (i_letter, letter) in enumerate(letters2):
+            text2.text = letter.upper()
+            buff = psychopy.visual.BufferImageStim(
+                win=win,
+                stim=[text2],
+                rect=cap_rect_norm)
+            i_rows = slice(i_letter * text_cap_size,
+                           i_letter * text_cap_size + text_cap_size)
+            text_strip2[i_rows, :] = (np.flipud(np.array(buff.image)[..., 0]) / 255.0 * 2.0 - 1.0)
+
+        # capture the rendering of each letter
+        for (i_letter, letter) in enumerate(letters3):
+            text3.text = letter.upper()
+            buff = psychopy.visual.BufferImageStim(
+                win=win,
+                stim=[text3],
+                rect=cap_rect_norm)
+            i_rows = slice(i_letter * text_cap_size,
+                           i_letter * text_cap_size + text_cap_size)
+            text_strip3[i_rows, :] = (np.flipud(np.array(buff.image)[..., 0]) / 255.0 * 2.0 - 1.0)
+
+        # need to pad 'text_strip' to pow2 to use as a texture
+        new_size = max([int(np.power(2, np.ceil(np.log(dim_size) / np.log(2))))
+                        for dim_size in text_strip.shape])
+        pad_amounts = []
+        for i_dim in range(2):
+            first_offset = int((new_size - text_strip.shape[i_dim]) / 2.0)
+            second_offset = new_size - text_strip.shape[i_dim] - first_offset
+            pad_amounts.append([first_offset, second_offset])
+        text_strip = np.pad(
+            array=text_strip,
+            pad_width=pad_amounts,
+            mode="constant",
+            constant_values=0.0)
+        text_strip = (text_strip - 1) * -1  # invert the texture mapping
+
+        text_strip2 = np.pad(
+            array=text_strip2,
+            pad_width=pad_amounts,
+            mode="constant",
+            constant_values=0.0)
+        text_strip2 = (text_strip2 - 1) * -1  # invert the texture mapping
+
+        text_strip3 = np.pad(
+            array=text_strip3,
+            pad_width=pad_amounts,
+            mode="constant",
+            constant_values=0.0)
+        text_strip3 = (text_strip3 - 1) * -1  # invert the texture mapping
+
+        # make a central mask to show just one letter
+        el_mask = np.ones(text_strip.shape) * -1.0
+        # start by putting the visible section in the corner
+        el_mask[:text_cap_size, :text_cap_size] = 1.0
+
+        # then roll to the middle
+        el_mask = np.roll(el_mask,
+                          (int(new_size / 2 - text_cap_size / 2),) * 2,
+                          axis=(0, 1))
+
+        # make a central mask to show just one letter
+        el_mask2 = np.ones(text_strip2.shape) * -1.0
+        # start by putting the visible section in the corner
+        el_mask2[:text_cap_size, :text_cap_size] = 1.0
+
+        # then roll to the middle
+        el_mask2 = np.roll(el_mask2,
+                           (int(new_size / 2 - text_cap_size / 2),) * 2,
+                           axis=(0, 1))
+
+        # make a central mask to show just one letter
+        el_mask3 = np.ones(text_strip3.shape) * -1.0
+        # start by putting the visible section in the corner
+        el_mask3[:text_cap_size, :text_cap_size] = 1.0
+
+        # then roll to the middle
+        el_mask3 = np.roll(el_mask3,
+                           (int(new_size / 2 - text_cap_size / 2),) * 2,
+                           axis=(0, 1))
+
+        # work out the phase offsets for the different letters
+        base_phase = ((text_cap_size * (n_text / 2.0)) - (text_cap_size / 2.0)) / new_size
+
+        phase_inc = (text_cap_size) / float(new_size)
+
+        phases = np.array([
+            (0.0, base_phase - i_letter * phase_inc)
+            for i_letter in range(n_text)])
+        win.close()
+        save_glyph_cache(glyph_cache_key, [text_strip, text_strip2, text_strip3], el_mask, phases)
 
 # █████████████████████████████████████████████████████████████████████████████
 
@@ -886,6 +1809,8 @@ if __name__ == "__main__":
         useRetina=use_retina
     )
     [win_w, win_h] = win.size
+    frame_timer = FrameTimer(win)
+    atexit.register(frame_timer.save)  # also runs on core.quit()
     if use_retina:
         win_w, win_h = win_w / 2, win_h / 2
     if center_flash:  # if we want the visual stimuli to be only presented at the center of the screen
@@ -902,18 +1827,16 @@ if __name__ == "__main__":
                         for inlet in inlets:
                             inlet.close_stream()
                         os.kill(p.pid, sig.CTRL_C_EVENT)
-                        with open("eeg.csv", 'a') as csv_file:
-                            np.savetxt(csv_file, eeg, delimiter=',')
                     if use_cyton:
                         for inlet in inlets:
                             inlet.close_stream()
                         stop_cyton.set()
                         board.stop_stream()
-                        with open("eeg.csv", 'a') as csv_file:
-                            np.savetxt(csv_file, eeg, delimiter=',')
                     core.quit()
             trial_text = visual.TextStim(win, str(i_trial + 1) + '/' + str(len(sequence)), color=(-1, -1, -1),
                                          colorSpace='rgb')
+            frame_timer.start_trial('center')
+            frame_timer.mark('text')
             # 750ms fixation cross:
             for frame in range(ms_to_frame(isi_duration * 1000, refresh_rate)):
                 # if frame == 0:
@@ -924,7 +1847,7 @@ if __name__ == "__main__":
                 photosensor.color = (-1, -1, -1)
                 if use_photosensor:
                     photosensor.draw()
-                win.flip()
+                frame_timer.flip('isi')
             # 'stim_duration' seconds stimulation using flashing frequency approximation:
             phase_offset_str = str(phase_offset)
             phase_offset += 0.00001  # nudge phase slightly from points of sudden jumps for offsets that are pi
@@ -937,21 +1860,18 @@ if __name__ == "__main__":
                             frame_indices / refresh_rate) + phase_offset * np.pi)  # frequency approximation formula
                 for i_frame, frame in enumerate(trial):  # present the stimulation frame by frame
                     if i_frame == 0:
-                        with open("meta.csv", 'a') as csv_file:
-                            # csv_file.write(str(flickering_freq)+', '+phase_offset_str + ', ' + str(time.time()) +
-                            # '\n')
-                            csv_file.write(
-                                str(flickering_freq) + ', ' + phase_offset_str + ', ' + str(local_clock()) + '\n')
+                        event_log.log('onset', flickering_freq, float(phase_offset_str))
                         if use_dsi_trigger and (use_dsi_lsl or use_dsi7):  # send trigger signal to the trigger channel
                             msg = b'\x01\xe1\x01\x00\x01'
                             dsi_serial.write(msg)
+                            event_log.log('trigger', msg[-1])
                     square.color = (frame, frame, frame)
                     square.draw()
                     # photosensor.color = (frame, frame, frame)
                     photosensor.color = (1, 1, 1)
                     if use_photosensor:
                         photosensor.draw()
-                    win.flip()
+                    frame_timer.flip('stimulation')
             elif flash_mode == 'sine':  # if we want to use smoothed sine wave visual stimuli
                 trial = np.sin(2 * np.pi * flickering_freq * (
                             frame_indices / refresh_rate) + phase_offset * np.pi)  # frequency approximation formula
@@ -961,14 +1881,14 @@ if __name__ == "__main__":
                     photosensor.color = (frame, frame, frame)
                     if use_photosensor:
                         photosensor.draw()
-                    win.flip()
+                    frame_timer.flip('stimulation')
             elif flash_mode == 'chirp':
                 frame_times = np.linspace(0, stim_duration, int(stim_duration * refresh_rate))
                 trial = signal.chirp(frame_times, f0=10, f1=14, t1=5, method='linear')
                 for frame in trial:  # present the stimulation frame by frame
                     square.color = (frame, frame, frame)
                     square.draw()
-                    win.flip()
+                    frame_timer.flip('stimulation')
             elif flash_mode == 'dual band':
                 flickering_freq2 = phase_offset
                 phase_offset = 0.00001
@@ -980,7 +1900,7 @@ if __name__ == "__main__":
                 for frame in trial:  # present the stimulation frame by frame
                     square.color = (frame, frame, frame)
                     square.draw()
-                    win.flip()
+                    frame_timer.flip('stimulation')
 
     flickering_keyboard = create_32_keys()
     flickering_keyboard_caps = create_key_caps(text_strip, el_mask, phases)
@@ -1032,6 +1952,8 @@ if __name__ == "__main__":
                                        pos=[200, height / 2 - 50])
             acc_text.size = 50
             # acc_text.autoDraw = True
+            frame_timer.start_trial('test')
+            frame_timer.mark('text')
             phase_offset_str = str(phase_offset)
             keys = kb.getKeys()
             for thisKey in keys:
@@ -1039,17 +1961,13 @@ if __name__ == "__main__":
                     if use_dsi_lsl:
                         for inlet in inlets:
                             inlet.close_stream()
-                        print(eeg)
+                        print(eeg.count)
                         os.kill(p.pid, sig.CTRL_C_EVENT)
-                        with open("eeg.csv", 'a') as csv_file:
-                            np.savetxt(csv_file, eeg, delimiter=',')
                     if use_cyton:
                         for inlet in inlets:
                             inlet.close_stream()
                         stop_cyton.set()
                         board.stop_stream()
-                        with open("eeg.csv", 'a') as csv_file:
-                            np.savetxt(csv_file, eeg, delimiter=',')
                     core.quit()
             key_colors = np.array([[-1, -1, -1]] * (n_keyboard_classes + 1))
             key_colors[class_num] = [1, 1, 1]
@@ -1082,7 +2000,7 @@ if __name__ == "__main__":
                 #     flickering_keyboard.xys += linear_movement_vector
                 # flickering_keyboard.draw()
                 flickering_keyboard_caps.draw()
-                win.flip()
+                frame_timer.flip('isi')
             for frame in range(ms_to_frame(isi_duration * (1 / 2) * 1000, refresh_rate)):
                 trial_text.draw()
                 acc_text.draw()
@@ -1093,29 +2011,35 @@ if __name__ == "__main__":
                 #     flickering_keyboard.xys += linear_movement_vector
                 # flickering_keyboard.draw()
                 flickering_keyboard.draw()
-                win.flip()
+                frame_timer.flip('isi')
+            stopping_job = None
             flash_successful = False
             frame_start_time = -1
             while (not flash_successful):
-                # iter_frame = iter(enumerate(flickering_frames))
-                # for i_frame,frame in iter_frame:
-                for i_frame, frame in enumerate(flickering_frames):
-                    frame = np.append(frame, 1)
+                if use_dsi_lsl and make_predictions:
+                    epochs.expect()  # again for every attempt, a frame skip rejected the previous one
+                    if dynamic_stopping:
+                        stopping_job = inference.submit(stopping=True)
+                frame_colors, frame_positions = create_stimulus_schedule(
+                    flickering_frames, flickering_keyboard.xys, random_movements,
+                    linear_movement_vector if random_linear_movements else None)
+                frame_timer.mark('schedule')
+                for i_frame in range(len(frame_colors)):
                     next_flip = win.getFutureFlipTime()
                     trial_text.draw()
                     acc_text.draw()
-                    if random_movements:
-                        movement_vector = (np.random.random(size=[n_keyboard_classes, 2]) * 2 - 1) * 1
-                        flickering_keyboard.xys += movement_vector
-                    if random_linear_movements:
-                        flickering_keyboard.xys += linear_movement_vector
-                    flickering_keyboard.colors = np.array([frame] * 3).T
+                    if frame_positions is not None:
+                        flickering_keyboard.xys = frame_positions[i_frame]
+                    flickering_keyboard.colors = frame_colors[i_frame]
                     flickering_keyboard.draw()
                     if core.getTime() > next_flip:
+                        event_log.log('frameskip', i_frame)
+                        end_stimulation(stopping_job, aborted=True)
                         if use_dsi_trigger and (use_dsi_lsl or use_dsi7):
                             # msg = b'\x01\xe1\x01\x00\x02'
                             msg = b'\x02'  # if use trigger hub
                             dsi_serial.write(msg)
+                            event_log.log('trigger', msg[-1])
                         n_frameskip += 1
                         print(str(n_frameskip) + '/' + str(i_trial + 1))
                         key_colors = np.array([[-1, -1, -1]] * (n_keyboard_classes + 1))
@@ -1123,59 +2047,36 @@ if __name__ == "__main__":
                         flickering_keyboard.colors = key_colors
                         for failure_frame in range(60):
                             flickering_keyboard.draw()
-                            win.flip()
+                            frame_timer.flip('failure')
                         break
-                    win.flip()
+                    frame_timer.flip('stimulation')
 
                     if i_frame == 0:
                         if use_dsi_trigger and (use_dsi_lsl or use_dsi7):
                             # msg = b'\x01\xe1\x01\x00\x01'
                             msg = b'\x01'  # if use trigger hub
                             dsi_serial.write(msg)
+                            event_log.log('trigger', msg[-1])
                         frame_start_time = local_clock()
-                    if i_frame == stim_duration_frames - 1:
+                    if i_frame == stim_duration_frames - 1 or stimulation_stopped(stopping_job):
                         flash_successful = True
-                        with open("meta.csv", 'a') as csv_file:
-                            csv_file.write(
-                                str(flickering_freq) + ', ' + str(phase_offset) + ', ' + str(frame_start_time) + '\n')
+                        event_log.log('onset', flickering_freq, phase_offset, frame_start_time)
+                        if end_stimulation(stopping_job):
+                            event_log.log('stop', stopping_job.stop_window, i_frame + 1)
+                            break
             key_colors = np.array([[1, 1, 1]] * (n_keyboard_classes + 1))
             # flickering_keyboard.colors = key_colors
             flickering_keyboard_caps.colors = key_colors
             prediction = [-1]
             if use_dsi_lsl and make_predictions:
-                # trial_eeg = np.copy(eeg[-700:])
-                time_window = -int(stim_duration * 300) - 200
-                trial_eeg = np.copy(eeg[time_window:])
-                if (len(np.where(trial_eeg[:, -1] == 2.0)[0]) == 0):  # 2.0 or 18.0
-                    # print(trial_eeg[np.where(trial_eeg[:,-1]==16.0)[0][0]+40:,1:-1].T.shape)
-                    # prediction = model.predict(trial_eeg[np.where(trial_eeg[:,-1]==1.0)[0][0]+40:,1:-1].T) # 1 or 16
-                    dsi24chans = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 18, 19, 22, 23]
-                    trial_start = np.where(trial_eeg[:, -1] == 16)[0][0] + 43
-                    if trial_eeg[trial_start - 44, -1] != 0:
-                        print(str(i_trial) + ':beginning not found1')
-                    # trial_eeg = trial_eeg[trial_start:trial_start+600,dsi24chans].T
-                    trial_eeg = trial_eeg[trial_start:trial_start + int(stim_duration * 300), dsi24chans].T
-                    # print(trial_eeg.shape)
-                    beginning_found = False
-                    # while trial_eeg.shape[1] < 600:
-                    while trial_eeg.shape[1] < int(stim_duration * 300):
-                        # trial_eeg = np.copy(eeg[-700:])
-                        trial_eeg = np.copy(eeg[time_window:])
-                        trial_start = np.where(trial_eeg[:, -1] == 16)[0][0] + 43
-                        if trial_eeg[trial_start - 44, -1] != 0:
-                            # if trial_eeg[-1,trial_start-1] != 0:
-                            beginning_found = False
-                        else:
-                            beginning_found = True
-                        # trial_eeg = trial_eeg[trial_start:trial_start+600,dsi24chans].T
-                        trial_eeg = trial_eeg[trial_start:trial_start + int(stim_duration * 300), dsi24chans].T
-                    # print(trial_eeg.shape)
-                    if not beginning_found:
-                        print(str(i_trial) + ':beginning not found2')
-                    eeg_temp[class_num].append(trial_eeg)
-                    # prediction = model.predict(trial_eeg[np.where(trial_eeg[:,-1]==16)[0][0]+42:,dsi24chans].T)
-                    prediction = model.predict(trial_eeg)
+                job = stopping_job or inference.submit()
+                if wait_for_prediction(job, [trial_text, acc_text, flickering_keyboard_caps]) is not None:
+                    if not job.clean_onset:
+                        print(str(i_trial) + ':beginning not found')
+                    eeg_temp[class_num].append(job.epoch)
+                    prediction = job.prediction
                     predited_class_num = keyboard_classes.index(classes[prediction[0]])
+                    event_log.log('prediction', predited_class_num)
                     # print(prediction[0])
                     key_colors[predited_class_num] = [-1, 1, -1]
                     if prediction == class_num:
@@ -1185,9 +2086,11 @@ if __name__ == "__main__":
                 acc_text.draw()
                 # flickering_keyboard.draw()
                 flickering_keyboard_caps.draw()
-                win.flip()
-        with open("eeg.csv", 'a') as csv_file:
-            np.savetxt(csv_file, eeg, delimiter=',')  # finish save
+                frame_timer.flip('feedback')
+        if use_dsi_lsl or use_cyton:
+            print(synchronizer.report())
+        if use_dsi_lsl and make_predictions:
+            print(inference.report())
         # eeg_np = np.array(eeg_temp).transpose(1, 0, 2, 3)
 
         # with open('eeg.npy', 'wb') as f:
@@ -1204,6 +2107,8 @@ if __name__ == "__main__":
                                          pos=[-300, 0], alignText='left')
             input_text.size = 40
             i_trial += 1
+            frame_timer.start_trial('home')
+            frame_timer.mark('text')
             keys = kb.getKeys()
             for thisKey in keys:
                 if thisKey == 'escape':
@@ -1211,15 +2116,11 @@ if __name__ == "__main__":
                         for inlet in inlets:
                             inlet.close_stream()
                         os.kill(p.pid, sig.CTRL_C_EVENT)
-                        with open("eeg.csv", 'a') as csv_file:
-                            np.savetxt(csv_file, eeg, delimiter=',')
                     if use_cyton:
                         for inlet in inlets:
                             inlet.close_stream()
                         stop_cyton.set()
                         board.stop_stream()
-                        with open("eeg.csv", 'a') as csv_file:
-                            np.savetxt(csv_file, eeg, delimiter=',')
                     core.quit()
             key_colors = np.array([[-1, -1, -1]] * (n_keyboard_classes + 1))
             # flickering_keyboard.colors = key_colors
@@ -1229,26 +2130,35 @@ if __name__ == "__main__":
             for frame in range(ms_to_frame(isi_duration * (1 / 2) * 1000, refresh_rate)):
                 flickering_keyboard_caps.draw()
                 input_text.draw()
-                win.flip()
+                frame_timer.flip('isi')
             key_colors = np.array([[-1, -1, -1]] * (n_keyboard_classes + 1))
             key_colors[:-1] = [1, 1, 1]
             flickering_keyboard.colors = key_colors
             for frame in range(ms_to_frame(isi_duration * (1 / 2) * 1000, refresh_rate)):
                 flickering_keyboard.draw()
-                win.flip()
+                frame_timer.flip('isi')
+            stopping_job = None
             flash_successful = False
             frame_start_time = -1
+            frame_colors, _ = create_stimulus_schedule(flickering_frames)
+            frame_timer.mark('schedule')
             while (not flash_successful):
-                for i_frame, frame in enumerate(flickering_frames):
-                    frame = np.append(frame, 1)
+                if use_dsi_lsl and make_predictions:
+                    epochs.expect()  # again for every attempt, a frame skip rejected the previous one
+                    if dynamic_stopping:
+                        stopping_job = inference.submit(stopping=True)
+                for i_frame in range(len(frame_colors)):
                     next_flip = win.getFutureFlipTime()
-                    flickering_keyboard.colors = np.array([frame] * 3).T
+                    flickering_keyboard.colors = frame_colors[i_frame]
                     flickering_keyboard.draw()
                     if core.getTime() > next_flip:
+                        event_log.log('frameskip', i_frame)
+                        end_stimulation(stopping_job, aborted=True)
                         if use_dsi_trigger and (use_dsi_lsl or use_dsi7):
                             # msg = b'\x01\xe1\x01\x00\x02'
                             msg = b'\x02'  # if use trigger hub
                             dsi_serial.write(msg)
+                            event_log.log('trigger', msg[-1])
                         n_frameskip += 1
                         print(str(n_frameskip) + '/' + str(i_trial + 1))
                         key_colors = np.array([[-1, -1, -1]] * (n_keyboard_classes + 1))
@@ -1257,52 +2167,40 @@ if __name__ == "__main__":
                         flickering_keyboard.colors = key_colors
                         for failure_frame in range(60):
                             flickering_keyboard.draw()
-                            win.flip()
+                            frame_timer.flip('failure')
                         break
-                    win.flip()
+                    frame_timer.flip('stimulation')
 
                     if i_frame == 0:
                         if use_dsi_trigger and (use_dsi_lsl or use_dsi7):
                             # msg = b'\x01\xe1\x01\x00\x01'
                             msg = b'\x01'  # if use trigger hub
                             dsi_serial.write(msg)
+                            event_log.log('trigger', msg[-1])
                         frame_start_time = local_clock()
-                    if i_frame == stim_duration_frames - 1:
+                    if i_frame == stim_duration_frames - 1 or stimulation_stopped(stopping_job):
                         flash_successful = True
-                        with open("meta.csv", 'a') as csv_file:
-                            csv_file.write(
-                                str(flickering_freq) + ', ' + str(phase_offset) + ', ' + str(frame_start_time) + '\n')
+                        event_log.log('onset', flickering_freq, phase_offset, frame_start_time)
+                        if end_stimulation(stopping_job):
+                            event_log.log('stop', stopping_job.stop_window, i_frame + 1)
+                            break
             key_colors = np.array([[1, 1, 1]] * (n_keyboard_classes + 1))
             key_colors[:20] = [0, 0, 0]
             flickering_keyboard_caps.colors = key_colors
             prediction = [-1]
             if use_dsi_lsl and make_predictions:
-                time_window = -int(stim_duration * 300) - 200
-                trial_eeg = np.copy(eeg[time_window:])
-                if (len(np.where(trial_eeg[:, -1] == 2.0)[0]) == 0):  # 2.0 or 18.0
-                    dsi24chans = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 18, 19, 22, 23]
-                    trial_start = np.where(trial_eeg[:, -1] == 16)[0][0] + 43
-                    if trial_eeg[trial_start - 44, -1] != 0:
-                        print(str(i_trial) + ':beginning not found1')
-                    trial_eeg = trial_eeg[trial_start:trial_start + int(stim_duration * 300), dsi24chans].T
-                    beginning_found = False
-                    while trial_eeg.shape[1] < int(stim_duration * 300):
-                        trial_eeg = np.copy(eeg[time_window:])
-                        trial_start = np.where(trial_eeg[:, -1] == 16)[0][0] + 43
-                        if trial_eeg[trial_start - 44, -1] != 0:
-                            beginning_found = False
-                        else:
-                            beginning_found = True
-                        trial_eeg = trial_eeg[trial_start:trial_start + int(stim_duration * 300), dsi24chans].T
-                    if not beginning_found:
-                        print(str(i_trial) + ':beginning not found2')
-                    prediction = model.predict(trial_eeg)
+                job = stopping_job or inference.submit()
+                if wait_for_prediction(job, [flickering_keyboard_caps]) is not None:
+                    if not job.clean_onset:
+                        print(str(i_trial) + ':beginning not found')
+                    prediction = job.prediction
                     predited_class_num = keyboard_classes.index(classes[prediction[0]])
+                    event_log.log('prediction', predited_class_num)
                     # print(prediction[0])
                     key_colors[predited_class_num] = [-1, 1, -1]
             for frame in range(ms_to_frame(isi_duration * (1 / 2) * 1000, refresh_rate)):
                 flickering_keyboard_caps.draw()
-                win.flip()
+                frame_timer.flip('feedback')
     else:
         pred_text = ''
         first_trial = True
@@ -1311,8 +2209,12 @@ if __name__ == "__main__":
         mid_timeout = False
         long_timeout = False
         screen = 'keyboard'
+        logged_screen = None
         caps2 = False
         while True:
+            if screen != logged_screen:
+                event_log.log('screen', screen_codes[screen])
+                logged_screen = screen
             if screen == 'keyboard':
                 short_pred_text = pred_text
                 if '\n' in short_pred_text:
@@ -1322,6 +2224,8 @@ if __name__ == "__main__":
                 top_text = visual.TextStim(win, short_pred_text, color=(-1, -1, -1), colorSpace='rgb', units='pix',
                                            pos=[0, height / 2 - 50], wrapWidth=1500, alignText='left')
                 top_text.size = 50
+                frame_timer.start_trial('keyboard')
+                frame_timer.mark('text')
                 keys = kb.getKeys()
                 for thisKey in keys:
                     if thisKey == 'escape':
@@ -1330,7 +2234,6 @@ if __name__ == "__main__":
                                 inlet.close_stream()
                             os.kill(p.pid, sig.CTRL_C_EVENT)
                         core.quit()
-                iter_frame = iter(enumerate(flickering_frames))
                 key_colors = np.array([[-1, -1, -1]] * (n_keyboard_classes + 1))
                 key_colors[:-1] = [1, 1, 1]
                 flickering_keyboard.colors = key_colors
@@ -1340,60 +2243,65 @@ if __name__ == "__main__":
                 for frame in range(ms_to_frame(isi_duration / 4 * 1000, refresh_rate)):
                     flickering_keyboard.draw()
                     top_text.draw()
-                    win.flip()
-                for i_frame, frame in iter_frame:
+                    frame_timer.flip('isi')
+                stopping_job = None
+                if use_dsi_lsl and make_predictions:
+                    epochs.expect()
+                    if dynamic_stopping and not first_trial:
+                        stopping_job = inference.submit(stopping=True)
+                frame_start_time = -1
+                frame_colors, frame_positions = create_stimulus_schedule(
+                    flickering_frames, flickering_keyboard.xys, random_movements,
+                    linear_movement_vector if random_linear_movements else None)
+                frame_timer.mark('schedule')
+                for i_frame in range(len(frame_colors)):
                     next_flip = win.getFutureFlipTime()
-                    if random_movements:
-                        movement_vector = (np.random.random(size=[n_keyboard_classes, 2]) * 2 - 1) * 1
-                        flickering_keyboard.xys += movement_vector
-                    if random_linear_movements:
-                        flickering_keyboard.xys += linear_movement_vector
-                    frame = np.append(frame, 1)
-                    flickering_keyboard.colors = np.array([frame] * 3).T
+                    if frame_positions is not None:
+                        flickering_keyboard.xys = frame_positions[i_frame]
+                    flickering_keyboard.colors = frame_colors[i_frame]
                     flickering_keyboard.draw()
                     top_text.draw()
                     if core.getTime() > next_flip:
+                        event_log.log('frameskip', i_frame)
+                        end_stimulation(stopping_job, aborted=True)
                         if use_dsi_trigger and (use_dsi_lsl or use_dsi7):
                             # msg = b'\x01\xe1\x01\x00\x02'
                             msg = b'\x02'  # if use trigger hub
                             dsi_serial.write(msg)
+                            event_log.log('trigger', msg[-1])
                         key_colors = np.array([[-1, -1, -1]] * (n_keyboard_classes + 1))
                         key_colors[:-1] = [1, -1, -1]
                         flickering_keyboard.colors = key_colors
                         for failure_frame in range(15):
                             flickering_keyboard.draw()
-                            win.flip()
+                            frame_timer.flip('failure')
                         break
-                    win.flip()
+                    frame_timer.flip('stimulation')
                     if i_frame == 0 and use_dsi_trigger and use_dsi_lsl:
                         # msg = b'\x01\xe1\x01\x00\x01'
                         msg = b'\x01'  # if use trigger hub
                         dsi_serial.write(msg)
+                        event_log.log('trigger', msg[-1])
+                    if i_frame == 0:
+                        frame_start_time = local_clock()
+                    if i_frame == len(frame_colors) - 1 or stimulation_stopped(stopping_job):
+                        event_log.log('onset', flickering_freq, phase_offset, frame_start_time)
+                        if end_stimulation(stopping_job):
+                            event_log.log('stop', stopping_job.stop_window, i_frame + 1)
+                            break
                 key_colors = np.array([[-1, -1, -1]] * (n_keyboard_classes + 1))
                 key_colors[:-1] = [1, 1, 1]
                 flickering_keyboard.colors = key_colors
                 if use_dsi_lsl and make_predictions and not first_trial:
-                    time_window = -int(stim_duration * 300) - 200
-                    trial_eeg = np.copy(eeg[time_window:])
-                    if (len(np.where(trial_eeg[:, -1] == 2.0)[0]) == 0):  # 2.0 or 18.0
-                        dsi24chans = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 18, 19, 22, 23]
-                        trial_start = np.where(trial_eeg[:, -1] == 16)[0][0] + 43
-                        if trial_eeg[trial_start - 44, -1] != 0:
-                            print(':beginning not found1')
-                        trial_eeg = trial_eeg[trial_start:trial_start + int(stim_duration * 300), dsi24chans].T
-                        beginning_found = False
-                        while trial_eeg.shape[1] < int(stim_duration * 300):
-                            trial_eeg = np.copy(eeg[time_window:])
-                            trial_start = np.where(trial_eeg[:, -1] == 16)[0][0] + 43
-                            if trial_eeg[trial_start - 44, -1] != 0:
-                                beginning_found = False
-                            else:
-                                beginning_found = True
-                            trial_eeg = trial_eeg[trial_start:trial_start + int(stim_duration * 300), dsi24chans].T
-                        if not beginning_found:
-                            print(':beginning not found2')
-                        prediction = model.predict(trial_eeg)
+                    job = stopping_job or inference.submit()
+                    if wait_for_prediction(job, [flickering_keyboard, top_text]) is not None:
+                        if not job.clean_onset:
+                            print(':beginning not found')
+                        prediction = job.prediction
                         predited_class_num = keyboard_classes.index(classes[prediction[0]])
+                        if language_model is not None and job.scores is not None and not caps2:
+                            predited_class_num = fuse_language_model(job, letters, pred_text)
+                        event_log.log('prediction', predited_class_num)
                         key_colors[predited_class_num] = [-1, 1, -1]
                         if caps2 == False:
                             pred_letter = letters[predited_class_num]
@@ -1424,6 +2332,7 @@ if __name__ == "__main__":
                             predited_class_num = dummy_keyboard_string.index(thisKey.name)
                         elif thisKey.name == 'comma':
                             predited_class_num = dummy_keyboard_string.index(',')
+                    event_log.log('prediction', predited_class_num)
                     key_colors[predited_class_num] = [-1, 1, -1]
                     if caps2 == False:
                         pred_letter = letters[predited_class_num]
@@ -1456,7 +2365,7 @@ if __name__ == "__main__":
                     else:
                         flickering_keyboard_caps.draw()
                     top_text.draw()
-                    win.flip()
+                    frame_timer.flip('feedback')
             elif screen == 'homescreen':
                 input_text = visual.TextStim(win, 'Input: ' + pred_text, color=(-1, -1, -1), colorSpace='rgb', units='pix',
                                              wrapWidth=850, pos=[-300, -270], alignText='left')
@@ -1465,6 +2374,19 @@ if __name__ == "__main__":
                 chat_history = visual.TextStim(win, chat_history_text, color=(-1, -1, -1), colorSpace='rgb', units='pix',
                                              wrapWidth=850, pos=[-300, 300], alignText='left',anchorVert='top')
                 chat_history.size = 30
+                completions = {}  # spare key: word completing the last word of pred_text
+                completion_texts = []
+                if language_model is not None:
+                    spare_keys = [i_key for i_key, key in enumerate(letters3[:n_keyboard_classes]) if key == ' ']
+                    completions = dict(zip(spare_keys, language_model.completions(last_word(pred_text),
+                                                                                  len(spare_keys))))
+                    for i_key, word in completions.items():
+                        completion_texts.append(visual.TextStim(win, word, color=(-1, -1, -1), colorSpace='rgb',
+                                                                units='pix', pos=flickering_keyboard_caps3.xys[i_key],
+                                                                wrapWidth=115, height=24))
+                frame_timer.start_trial('homescreen')
+                frame_timer.mark('text')
+                frame_timer.mark('io')
                 keys = kb.getKeys()
                 for thisKey in keys:
                     if thisKey == 'escape':
@@ -1472,15 +2394,11 @@ if __name__ == "__main__":
                             for inlet in inlets:
                                 inlet.close_stream()
                             os.kill(p.pid, sig.CTRL_C_EVENT)
-                            with open("eeg.csv", 'a') as csv_file:
-                                np.savetxt(csv_file, eeg, delimiter=',')
                         if use_cyton:
                             for inlet in inlets:
                                 inlet.close_stream()
                             stop_cyton.set()
                             board.stop_stream()
-                            with open("eeg.csv", 'a') as csv_file:
-                                np.savetxt(csv_file, eeg, delimiter=',')
                         core.quit()
                 key_colors = np.array([[-1, -1, -1]] * (n_keyboard_classes + 1))
                 # flickering_keyboard.colors = key_colors
@@ -1489,75 +2407,74 @@ if __name__ == "__main__":
 
                 for frame in range(ms_to_frame(isi_duration * (1 / 2) * 1000, refresh_rate)):
                     flickering_keyboard_caps3.draw()
+                    for completion_text in completion_texts:
+                        completion_text.draw()
                     input_text.draw()
                     chat_history.draw()
-                    win.flip()
+                    frame_timer.flip('isi')
                 key_colors = np.array([[-1, -1, -1]] * (n_keyboard_classes + 1))
                 key_colors[:-1] = [1, 1, 1]
                 flickering_keyboard.colors = key_colors
                 for frame in range(ms_to_frame(isi_duration / 4 * 1000, refresh_rate)):
                     flickering_keyboard.draw()
-                    win.flip()
+                    frame_timer.flip('isi')
+                stopping_job = None
                 flash_successful = False
                 frame_start_time = -1
+                frame_colors, _ = create_stimulus_schedule(flickering_frames)
+                frame_timer.mark('schedule')
                 while (not flash_successful):
-                    for i_frame, frame in enumerate(flickering_frames):
-                        frame = np.append(frame, 1)
+                    if use_dsi_lsl and make_predictions:
+                        epochs.expect()  # again for every attempt, a frame skip rejected the previous one
+                        if dynamic_stopping:
+                            stopping_job = inference.submit(stopping=True)
+                    for i_frame in range(len(frame_colors)):
                         next_flip = win.getFutureFlipTime()
-                        flickering_keyboard.colors = np.array([frame] * 3).T
+                        flickering_keyboard.colors = frame_colors[i_frame]
                         flickering_keyboard.draw()
                         if core.getTime() > next_flip:
+                            event_log.log('frameskip', i_frame)
+                            end_stimulation(stopping_job, aborted=True)
                             if use_dsi_trigger and (use_dsi_lsl or use_dsi7):
                                 # msg = b'\x01\xe1\x01\x00\x02'
                                 msg = b'\x02'  # if use trigger hub
                                 dsi_serial.write(msg)
+                                event_log.log('trigger', msg[-1])
                             key_colors = np.array([[-1, -1, -1]] * (n_keyboard_classes + 1))
                             key_colors[:-1] = [1, -1, -1]
                             # key_colors[class_num] = [1,-1,-1]
                             flickering_keyboard.colors = key_colors
                             for failure_frame in range(60):
                                 flickering_keyboard.draw()
-                                win.flip()
+                                frame_timer.flip('failure')
                             break
-                        win.flip()
+                        frame_timer.flip('stimulation')
 
                         if i_frame == 0:
                             if use_dsi_trigger and (use_dsi_lsl or use_dsi7):
                                 # msg = b'\x01\xe1\x01\x00\x01'
                                 msg = b'\x01'  # if use trigger hub
                                 dsi_serial.write(msg)
+                                event_log.log('trigger', msg[-1])
                             frame_start_time = local_clock()
-                        if i_frame == stim_duration_frames - 1:
+                        if i_frame == stim_duration_frames - 1 or stimulation_stopped(stopping_job):
                             flash_successful = True
-                            with open("meta.csv", 'a') as csv_file:
-                                csv_file.write(str(flickering_freq) + ', ' + str(phase_offset) + ', ' + str(
-                                    frame_start_time) + '\n')
+                            event_log.log('onset', flickering_freq, phase_offset, frame_start_time)
+                            if end_stimulation(stopping_job):
+                                event_log.log('stop', stopping_job.stop_window, i_frame + 1)
+                                break
                 key_colors = np.array([[1, 1, 1]] * (n_keyboard_classes + 1))
                 key_colors[:20] = [0, 0, 0]
                 flickering_keyboard_caps3.colors = key_colors
                 prediction = [-1]
                 if use_dsi_lsl and make_predictions:
-                    time_window = -int(stim_duration * 300) - 200
-                    trial_eeg = np.copy(eeg[time_window:])
-                    if (len(np.where(trial_eeg[:, -1] == 2.0)[0]) == 0):  # 2.0 or 18.0
-                        dsi24chans = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 18, 19, 22, 23]
-                        trial_start = np.where(trial_eeg[:, -1] == 16)[0][0] + 43
-                        if trial_eeg[trial_start - 44, -1] != 0:
-                            print(str(i_trial) + ':beginning not found1')
-                        trial_eeg = trial_eeg[trial_start:trial_start + int(stim_duration * 300), dsi24chans].T
-                        beginning_found = False
-                        while trial_eeg.shape[1] < int(stim_duration * 300):
-                            trial_eeg = np.copy(eeg[time_window:])
-                            trial_start = np.where(trial_eeg[:, -1] == 16)[0][0] + 43
-                            if trial_eeg[trial_start - 44, -1] != 0:
-                                beginning_found = False
-                            else:
-                                beginning_found = True
-                            trial_eeg = trial_eeg[trial_start:trial_start + int(stim_duration * 300), dsi24chans].T
-                        if not beginning_found:
-                            print(str(i_trial) + ':beginning not found2')
-                        prediction = model.predict(trial_eeg)
+                    job = stopping_job or inference.submit()
+                    if wait_for_prediction(job, [flickering_keyboard_caps3, input_text, chat_history] + completion_texts) is not None:
+                        if not job.clean_onset:
+                            print(str(i_trial) + ':beginning not found')
+                        prediction = job.prediction
                         predited_class_num = keyboard_classes.index(classes[prediction[0]])
+                        event_log.log('prediction', predited_class_num)
                         # print(prediction[0])
                         key_colors[predited_class_num] = [-1, 1, -1]
                         pred_letter = letters3[predited_class_num]
@@ -1567,6 +2484,10 @@ if __name__ == "__main__":
                         if pred_letter == '⌨':
                             screen = 'keyboard'
                             first_trial = True
+                        elif predited_class_num in completions:
+                            pred_text = complete_word(pred_text, completions[predited_class_num])
+                            screen = 'keyboard'
+                            first_trial = True
                         elif pred_letter == '⌫':
                             pred_text = pred_text[:-1]
                         elif pred_letter == '⎚':
@@ -1581,6 +2502,7 @@ if __name__ == "__main__":
                             mid_timeout = True
                         elif pred_letter == '✉':
                             update_text(pred_text + '\u2709')
+                            frame_timer.mark('io')
                             pred_text = ''
                         elif pred_letter == '⏰':
                             long_timeout = True
@@ -1598,6 +2520,7 @@ if __name__ == "__main__":
                             predited_class_num = dummy_keyboard_string.index(thisKey.name)
                         elif thisKey.name == 'comma':
                             predited_class_num = dummy_keyboard_string.index(',')
+                    event_log.log('prediction', predited_class_num)
                     key_colors[predited_class_num] = [-1, 1, -1]
                     pred_letter = letters3[predited_class_num]
                     if pred_letter != '⎚':
@@ -1605,6 +2528,10 @@ if __name__ == "__main__":
                     if pred_letter == '⌨':
                         screen = 'keyboard'
                         first_trial = True
+                    elif predited_class_num in completions:
+                        pred_text = complete_word(pred_text, completions[predited_class_num])
+                        screen = 'keyboard'
+                        first_trial = True
                     elif pred_letter == '⌫':
                         pred_text = pred_text[:-1]
                     elif pred_letter == '⎚':
@@ -1615,6 +2542,7 @@ if __name__ == "__main__":
                             clear_text_double_check = True
                     elif pred_letter == '✉':
                         update_text(pred_text + '\u2709')
+                        frame_timer.mark('io')
                         pred_text = ''
                     elif pred_letter == '⏳':
                         short_timeout = True
@@ -1633,12 +2561,15 @@ if __name__ == "__main__":
                 speed_text = visual.TextStim(win, 'speed: ' + str(speed), color=(-1, -1, -1), colorSpace='rgb',
                                              units='pix', pos=[0, height / 2 - 50], wrapWidth=1500, alignText='left')
                 speed_text.size = 50
+                frame_timer.mark('text')
                 for frame in range(ms_to_frame(isi_duration / 1.5 * 1000, refresh_rate)):
                     speed_text.draw()
                     flickering_keyboard_caps3.draw()
+                    for completion_text in completion_texts:
+                        completion_text.draw()
                     input_text.draw()
                     chat_history.draw()
-                    win.flip()
+                    frame_timer.flip('feedback')
 
                 if short_timeout or mid_timeout or long_timeout:
                     if short_timeout:
@@ -1660,34 +2591,30 @@ if __name__ == "__main__":
                                     for inlet in inlets:
                                         inlet.close_stream()
                                     os.kill(p.pid, sig.CTRL_C_EVENT)
-                                    with open("eeg.csv", 'a') as csv_file:
-                                        np.savetxt(csv_file, eeg, delimiter=',')
                                 if use_cyton:
                                     for inlet in inlets:
                                         inlet.close_stream()
                                     stop_cyton.set()
                                     board.stop_stream()
-                                    with open("eeg.csv", 'a') as csv_file:
-                                        np.savetxt(csv_file, eeg, delimiter=',')
                                 core.quit()
                         time_left = timer.getTime()
                         timeout_text.text = 'Timeout: ' + str(round(time_left, 3))
+                        frame_timer.mark('text')
                         timeout_text.draw()
                         flickering_keyboard_caps3.draw()
                         input_text.draw()
                         chat_history.draw()
-                        win.flip()
+                        frame_timer.flip('timeout')
                     short_timeout = False
                     mid_timeout = False
                     long_timeout = False
 
+    if use_dsi_lsl or use_cyton:
+        print(synchronizer.report())
+    if use_dsi_lsl and make_predictions:
+        print(inference.report())
     if use_dsi_lsl:
         for inlet in inlets:
             inlet.close_stream()
         os.kill(p.pid, sig.CTRL_C_EVENT)
-        with open("eeg.csv", 'a') as csv_file:
-            np.savetxt(csv_file, eeg, delimiter=',')
-    if use_cyton:
-        with open("eeg.csv", 'a') as csv_file:
-            np.savetxt(csv_file, eeg, delimiter=',')
     core.quit()
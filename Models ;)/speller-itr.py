@@ -0,0 +1,161 @@
+"""
+SSVEP Speller ITR Report
+
+Reads the event log of a test_mode session of oz-speller.py (events.bin, written by EventLog) and reports the
+accuracy, the selection time and the Wolpaw information transfer rate in bits/min, overall, per keyboard class and
+per flickering frequency.
+
+Notes:
+- In test_mode the 'onset' events carry the (frequency, phase) of the target, the same rows as in meta.csv, and the
+  'prediction' event logged after an onset is the predicted keyboard class of that trial
+- trials without a prediction (rejected or timed out) count as errors
+- the nominal selection time is stim_duration + isi_duration (half of the ISI before the stimulation, half after as
+  feedback) as set in oz-speller.py; the measured selection time is the median time between consecutive onsets and
+  also includes the prediction wait and, with dynamic stopping, the shorter stimulations
+- pass a previous JSON report with --baseline to print the change of the main numbers
+
+Usage:
+    python speller-itr.py --events events.bin --isi 1 --stim-duration 1.2
+    python speller-itr.py --events events.bin --output report.json --baseline old_report.json
+"""
+
+import argparse, json, sys, time
+import numpy as np
+
+# the same as in oz-speller.py (see EventLog there)
+event_codes = {'start': 0, 'onset': 1, 'trigger': 2, 'prediction': 3, 'frameskip': 4, 'screen': 5, 'stop': 6}
+event_dtype = np.dtype([('time', 'f8'), ('event', 'u1'), ('a', 'f8'), ('b', 'f8')])
+keyboard_classes = [(freq, phase) for freq in range(8, 16) for phase in (0, 0.5, 1, 1.5)]
+
+
+def wolpaw_itr(n_classes, accuracy, selection_time):
+    """ Wolpaw information transfer rate
+
+    Parameters
+    ----------
+    n_classes : int
+    accuracy : float
+        between 0 and 1
+    selection_time : float
+        seconds per selection
+
+    Returns
+    -------
+    bits per minute; 0 at or below chance accuracy
+    """
+    if accuracy <= 1 / n_classes:
+        return 0.0
+    bits = np.log2(n_classes) + accuracy * np.log2(accuracy)
+    if accuracy < 1:
+        bits += (1 - accuracy) * np.log2((1 - accuracy) / (n_classes - 1))
+    return bits * 60 / selection_time
+
+
+def session_trials(events):
+    """ Pair every onset with the prediction logged before the next onset
+
+    Returns
+    -------
+    onset_times : [trials] onset times in seconds
+    targets : [trials] target keyboard class of each trial
+    predictions : [trials] predicted keyboard class, -1 if the trial has none
+    stop_times : [trials] stimulation length in seconds from the 'stop' events, nan if the trial ran to the end
+    """
+    order = np.argsort(events['time'], kind='stable')
+    events = events[order]
+    onsets = np.flatnonzero(events['event'] == event_codes['onset'])
+    bounds = np.append(onsets, len(events))
+    onset_times, targets, predictions, stop_times = [], [], [], []
+    for begin, end in zip(bounds[:-1], bounds[1:]):
+        onset = events[begin]
+        onset_times.append(onset['time'])
+        targets.append(keyboard_classes.index((int(onset['a']), float(onset['b']))))
+        trial = events[begin + 1:end]
+        predicted = trial[trial['event'] == event_codes['prediction']]
+        predictions.append(int(predicted['a'][0]) if len(predicted) else -1)
+        stopped = trial[trial['event'] == event_codes['stop']]
+        stop_times.append(stopped['time'][0] - onset['time'] if len(stopped) else np.nan)
+    return np.array(onset_times), np.array(targets), np.array(predictions), np.array(stop_times)
+
+
+def breakdown(names, groups, correct, predicted):
+    """ Trials, accuracy and rejected trials of every group; groups is the group of each trial """
+    rows = []
+    for group, name in enumerate(names):
+        selected = groups == group
+        if selected.any():
+            rows.append({'name': name, 'trials': int(selected.sum()), 'accuracy': float(correct[selected].mean()),
+                         'no_prediction': int((~predicted[selected]).sum())})
+    return rows
+
+
+def itr_report(events, isi_duration, stim_duration, n_classes=len(keyboard_classes)):
+    onset_times, targets, predictions, stop_times = session_trials(events)
+    if len(targets) == 0:
+        raise ValueError('no onset events in the log')
+    correct = predictions == targets
+    predicted = predictions >= 0
+    accuracy = float(correct.mean())
+    nominal_time = stim_duration + isi_duration
+    measured_time = float(np.median(np.diff(onset_times))) if len(onset_times) > 1 else nominal_time
+    frequencies = sorted({freq for freq, phase in keyboard_classes})
+    class_frequency = np.array([frequencies.index(keyboard_classes[target][0]) for target in targets])
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'n_classes': n_classes,
+        'trials': len(targets),
+        'no_prediction': int((~predicted).sum()),
+        'accuracy': accuracy,
+        'isi_duration': isi_duration,
+        'stim_duration': stim_duration,
+        'stopped_early': int(np.count_nonzero(~np.isnan(stop_times))),
+        'mean_stimulation': float(np.mean(np.where(np.isnan(stop_times), stim_duration, stop_times))),
+        'selection_time': {'nominal': nominal_time, 'measured': measured_time},
+        'itr_bits_per_min': {'nominal': wolpaw_itr(n_classes, accuracy, nominal_time),
+                             'measured': wolpaw_itr(n_classes, accuracy, measured_time)},
+        'per_class': breakdown(['%g Hz %g pi' % keyboard_class for keyboard_class in keyboard_classes], targets,
+                               correct, predicted),
+        'per_frequency': breakdown(['%g Hz' % freq for freq in frequencies], class_frequency, correct, predicted),
+    }
+
+
+def print_report(report):
+    print('%d trials, accuracy %.1f%% (%d without prediction), %d stopped early, mean stimulation %.2f s' % (
+        report['trials'], report['accuracy'] * 100, report['no_prediction'], report['stopped_early'],
+        report['mean_stimulation']))
+    for kind in ('nominal', 'measured'):
+        print('%-8s selection time %.2f s, ITR %.1f bits/min' % (
+            kind, report['selection_time'][kind], report['itr_bits_per_min'][kind]))
+    for title in ('per_frequency', 'per_class'):
+        print('\n' + title.replace('_', ' ') + ' (trials, accuracy, no prediction)')
+        for row in report[title]:
+            print('  %-14s %4d %6.1f%% %4d' % (row['name'], row['trials'], row['accuracy'] * 100, row['no_prediction']))
+
+
+def compare(report, baseline):
+    changes = ['accuracy %+.1f points' % ((report['accuracy'] - baseline['accuracy']) * 100)]
+    for kind in ('nominal', 'measured'):
+        changes.append('%s ITR %+.1f bits/min' % (
+            kind, report['itr_bits_per_min'][kind] - baseline['itr_bits_per_min'][kind]))
+    changes.append('measured selection time %+.2f s' % (
+        report['selection_time']['measured'] - baseline['selection_time']['measured']))
+    print('\nchange from baseline: ' + ', '.join(changes))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Accuracy and ITR of an oz-speller.py test_mode session.')
+    parser.add_argument('--events', default='events.bin', help='event log written by the speller')
+    parser.add_argument('--isi', type=float, default=1, help='isi_duration of the session in seconds')
+    parser.add_argument('--stim-duration', type=float, default=1.2, help='stim_duration of the session in seconds')
+    parser.add_argument('--output', default=None, help='file to write the JSON report to')
+    parser.add_argument('--baseline', default=None, help='previous JSON report to compare against')
+    args = parser.parse_args()
+
+    report = itr_report(np.fromfile(args.events, dtype=event_dtype), args.isi, args.stim_duration)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            compare(report, json.load(baseline_file))
@@ -0,0 +1,228 @@
+"""
+Speller Language Model
+
+Character n-gram and word model for oz-speller.py, trained offline from a local text corpus and stored in compact
+tries (flat numpy arrays in one .npz file).
+
+Notes:
+- the text is upper-cased and every character outside the alphabet becomes a space, like on the speller keyboard
+- char_probabilities() gives the prior of the next character (Witten-Bell interpolation of the n-gram orders), which
+  oz-speller.py fuses with the classifier scores of the letter keys
+- completions() gives the most frequent words starting with a prefix, offered on the spare homescreen keys
+
+Usage:
+    python speller_lm.py corpus.txt --order 5 --output reports/language_model/speller_lm.npz
+"""
+
+import argparse, heapq, os, re, string
+import numpy as np
+
+default_alphabet = string.ascii_uppercase + ' .,'  # the characters of the speller's letters layout
+
+
+class CompactTrie:
+    """ Trie of counted character sequences stored in flat arrays
+
+    Nodes are numbered in breadth-first order with the root as node 0, and the children
+    of a node are consecutive and sorted by character, so a child is found with a binary
+    search. best holds the highest terminal count below every node (a terminal is a child
+    with the character end), which lets completions() visit the most frequent sequences
+    first without walking the whole subtree.
+
+    Parameters
+    ----------
+    chars : [nodes] uint32 array
+        unicode code point of the character leading to each node (0 for the root)
+    counts : [nodes] uint32 array
+        how often the sequence ending at each node was inserted
+    first_child, n_children : [nodes] int32 arrays
+        index of the first child and number of children of each node
+    best : [nodes] uint32 array
+        highest terminal count in the subtree of each node
+    """
+
+    def __init__(self, chars, counts, first_child, n_children, best, end=' '):
+        self.chars = chars
+        self.counts = counts
+        self.first_child = first_child
+        self.n_children = n_children
+        self.best = best
+        self.end = end
+
+    @classmethod
+    def build(cls, sequences, end=' '):
+        """ Count every prefix of every sequence in sequences (an iterable of strings) """
+        root = [0, {}]
+        for sequence in sequences:
+            node = root
+            for char in sequence:
+                node = node[1].setdefault(char, [0, {}])
+                node[0] += 1
+        nodes = [('\0', root)]
+        first_child = [0]
+        n_children = [0]
+        i_node = 0
+        while i_node < len(nodes):  # breadth-first, appending the sorted children of every node
+            children = sorted(nodes[i_node][1][1].items())
+            first_child[i_node] = len(nodes)
+            n_children[i_node] = len(children)
+            nodes.extend(children)
+            first_child.extend([0] * len(children))
+            n_children.extend([0] * len(children))
+            i_node += 1
+        chars = np.array([ord(char) for char, node in nodes], dtype=np.uint32)
+        counts = np.array([node[0] for char, node in nodes], dtype=np.uint32)
+        first_child = np.array(first_child, dtype=np.int32)
+        n_children = np.array(n_children, dtype=np.int32)
+        best = np.where(chars == ord(end), counts, 0).astype(np.uint32)
+        for i_node in range(len(nodes) - 1, -1, -1):  # children come after their parent
+            if n_children[i_node]:
+                children = slice(first_child[i_node], first_child[i_node] + n_children[i_node])
+                best[i_node] = max(best[i_node], best[children].max())
+        return cls(chars, counts, first_child, n_children, best, end)
+
+    def child(self, node, char):
+        """ Index of the child of node reached by char, or -1 """
+        begin = self.first_child[node]
+        end = begin + self.n_children[node]
+        i_child = begin + int(np.searchsorted(self.chars[begin:end], ord(char)))
+        if i_child < end and self.chars[i_child] == ord(char):
+            return i_child
+        return -1
+
+    def find(self, sequence):
+        """ Index of the node of sequence, or -1 if it was never inserted """
+        node = 0
+        for char in sequence:
+            node = self.child(node, char)
+            if node < 0:
+                return -1
+        return node
+
+    def children(self, node):
+        """ (characters, counts) of the children of node """
+        children = slice(self.first_child[node], self.first_child[node] + self.n_children[node])
+        return self.chars[children], self.counts[children]
+
+    def completions(self, prefix, n=3):
+        """ The n most frequent terminated sequences starting with prefix, most frequent first """
+        node = self.find(prefix)
+        if node < 0:
+            return []
+        found = []
+        heap = [(-int(self.best[node]), prefix, node)]
+        while heap and len(found) < n:
+            best, sequence, node = heapq.heappop(heap)
+            if self.chars[node] == ord(self.end):
+                found.append(sequence[:-1])
+                continue
+            for i_child in range(self.first_child[node], self.first_child[node] + self.n_children[node]):
+                if self.best[i_child]:
+                    heapq.heappush(heap, (-int(self.best[i_child]), sequence + chr(self.chars[i_child]), i_child))
+        return found
+
+    def arrays(self, name):
+        return {name + '_' + field: getattr(self, field) for field in
+                ('chars', 'counts', 'first_child', 'n_children', 'best')}
+
+    @classmethod
+    def from_arrays(cls, arrays, name, end=' '):
+        return cls(*[arrays[name + '_' + field] for field in ('chars', 'counts', 'first_child', 'n_children', 'best')],
+                   end=end)
+
+
+class LanguageModel:
+    """ Character n-gram prior and word completions for the speller
+
+    Examples
+    --------
+    >>> language_model = LanguageModel.train(open('corpus.txt').read(), order=5)
+    >>> language_model.save('speller_lm.npz')
+    >>> language_model = LanguageModel.load('speller_lm.npz')
+    >>> prior = language_model.char_probabilities('HELL')  # {'A': ..., 'O': ..., ' ': ...}
+    >>> language_model.completions('HEL')  # ['HELLO', 'HELP', 'HELD']
+    """
+
+    def __init__(self, chars, words, order, alphabet=default_alphabet):
+        self.chars = chars
+        self.words = words
+        self.order = order
+        self.alphabet = alphabet
+        self.alphabet_index = np.full(max(ord(char) for char in alphabet) + 1, -1)
+        self.alphabet_index[[ord(char) for char in alphabet]] = np.arange(len(alphabet))
+
+    @staticmethod
+    def normalize(text, alphabet=default_alphabet):
+        """ Upper-case text, replace the characters outside alphabet with spaces and collapse the spaces """
+        text = ''.join(char if char in alphabet else ' ' for char in text.upper())
+        return re.sub(' +', ' ', text)
+
+    @classmethod
+    def train(cls, text, order=5, alphabet=default_alphabet):
+        text = cls.normalize(text, alphabet)
+        chars = CompactTrie.build(text[i:i + order] for i in range(len(text)))
+        words = CompactTrie.build(word + ' ' for word in re.findall(r'[^\W\d_]+', text))  # letters only
+        return cls(chars, words, order, alphabet)
+
+    def char_probabilities(self, context):
+        """ Probability of every character of the alphabet following context, as a dict """
+        context = self.normalize(context, self.alphabet)[-(self.order - 1):] if self.order > 1 else ''
+        probabilities = np.full(len(self.alphabet), 1 / len(self.alphabet))
+        for length in range(len(context) + 1):  # from the unigrams up to the longest context
+            node = self.chars.find(context[len(context) - length:])
+            if node < 0:
+                break
+            chars, counts = self.chars.children(node)
+            total = counts.sum()
+            if total == 0:
+                continue
+            observed = np.zeros(len(self.alphabet))
+            observed[self.alphabet_index[chars]] = counts  # the training text only has alphabet characters
+            n_types = len(chars)
+            probabilities = (observed + n_types * probabilities) / (total + n_types)
+        return dict(zip(self.alphabet, probabilities))
+
+    def completions(self, prefix, n=3):
+        """ The n most frequent words starting with prefix and longer than it (prefix must not be empty) """
+        prefix = self.normalize(prefix, self.alphabet).strip()
+        if not prefix:
+            return []
+        return [word for word in self.words.completions(prefix, n + 1) if word != prefix][:n]
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        np.savez_compressed(path, order=self.order, alphabet=self.alphabet,
+                            **self.chars.arrays('chars'), **self.words.arrays('words'))
+
+    @classmethod
+    def load(cls, path):
+        arrays = np.load(path)
+        return cls(CompactTrie.from_arrays(arrays, 'chars'), CompactTrie.from_arrays(arrays, 'words'),
+                   int(arrays['order']), str(arrays['alphabet']))
+
+
+def last_word(text):
+    """ The word being typed at the end of text, '' after a space or newline """
+    return re.split('[ \n]', text)[-1]
+
+
+def complete_word(text, word):
+    """ Replace the word being typed at the end of text with word, followed by a space """
+    return text[:len(text) - len(last_word(text))] + word + ' '
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Train the speller language model from a text corpus.')
+    parser.add_argument('corpus', nargs='+', help='text files')
+    parser.add_argument('--order', type=int, default=5, help='character n-gram order')
+    parser.add_argument('--output', default='reports/language_model/speller_lm.npz')
+    args = parser.parse_args()
+
+    text = ''
+    for path in args.corpus:
+        with open(path, encoding='utf-8', errors='ignore') as corpus_file:
+            text += corpus_file.read() + ' '
+    language_model = LanguageModel.train(text, args.order)
+    language_model.save(args.output)
+    print('%d characters, %d character n-gram nodes, %d word nodes written to %s' % (
+        len(text), len(language_model.chars.chars), len(language_model.words.chars), args.output))